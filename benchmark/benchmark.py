@@ -0,0 +1,474 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+# shared protocol modules (framing, ...) live in ../common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+import framing
+import wire
+
+
+"""
+LOAD GENERATOR
+Simulates many clients against a local server and prints one JSON object per scenario.
+
+connect : all clients connect at once                 -> accepted connections/s, RSS per connection
+churn   : clients repeatedly connect, !create / !join a lobby and !exit    -> lobby operations/s
+chat    : clients in rooms of --room-size send --messages chat lines each  -> messages/s, fan-out latency, CPU/message
+
+Without --port a server (server/server.py) is started on a free port, its RSS and CPU time are read from /proc.
+"""
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server", "server.py")
+
+SCENARIOS = ("connect", "churn", "chat")
+FLOOD_LIMIT = 1000000       # chat rate and burst of the rooms without --flood-control
+
+lobby_ids = itertools.count()       # unique lobby names across scenarios
+
+
+class BenchClient:
+    """
+    One simulated client.
+    """
+    def __init__(self, loop, host, port, codec, compress=False):
+        self.loop = loop
+        self.address = (host, port)
+        self.codec = codec
+        self.compress = compress
+
+        self.sock = None
+        self.reader = None
+
+    async def connect(self, timeout=None) -> None:
+        """
+        connects and waits for the joining message of the main lobby.
+        :param timeout: seconds until the joining message must have arrived
+                        (a full accept queue can leave a connection established on this side only)
+        :return: -
+        """
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        self.reader = framing.FrameReader(self.loop, self.sock)
+        await asyncio.wait_for(self._handshake(), timeout)
+
+    async def _handshake(self) -> None:
+        """
+        :return: -
+        """
+        await self.loop.sock_connect(self.sock, self.address)
+        if await self.receive() is None:
+            raise ConnectionError("[BenchClient] connection closed by the server.")
+
+        if self.codec == wire.BINARY:
+            await self.send(f"!wire {wire.BINARY}")
+            await self.receive()
+        if self.compress:
+            self.reader.decoder.accept_compression()
+            await self.send("!compress")
+            await self.receive()
+
+    async def send(self, text) -> None:
+        """
+        :param text: str
+        :return: -
+        """
+        await self.loop.sock_sendall(self.sock, framing.encode_frame(text.encode()))
+
+    async def receive(self) -> dict | None:
+        """
+        :return: next response of the server or None if the connection was closed
+        """
+        while (frame := await self.reader.read_frame()) is not None:
+            response = wire.decode_message(frame)
+            if not response["code"] == 6:
+                return response
+            # heartbeat of the server
+            await self.send("!pong")
+        return None
+
+    async def enter(self, command, lobby_name) -> None:
+        """
+        creates or joins a lobby and waits until the client is a member.
+        :param command: '!create' or '!join'
+        :param lobby_name: str
+        :return: -
+        """
+        await self.send(f"{command} {lobby_name}")
+        success = f"You successfully connected to {lobby_name}"
+        while (response := await self.receive()) is not None:
+            if response.get("msg") == success:
+                return
+            if response["code"] == 3:
+                raise ConnectionError(f"[BenchClient] {command} {lobby_name} failed: {response['msg']}")
+        raise ConnectionError(f"[BenchClient] connection closed during {command} {lobby_name}.")
+
+    def close(self) -> None:
+        """
+        :return: -
+        """
+        if self.sock is not None:
+            self.sock.close()
+
+
+class ServerProcess:
+    """
+    Resource usage of the server process (Linux /proc).
+    """
+    CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+    def __init__(self, pid):
+        self.pid = pid
+
+    def rss(self) -> int:
+        """
+        :return: resident set size in bytes (0 if unknown)
+        """
+        try:
+            with open(f"/proc/{self.pid}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return 0
+
+    def cpu_time(self) -> float:
+        """
+        :return: user + system CPU seconds of the server (0 if unknown)
+        """
+        try:
+            with open(f"/proc/{self.pid}/stat") as stat:
+                fields = stat.read().rsplit(")", 1)[1].split()
+        except OSError:
+            return 0.0
+        return (int(fields[11]) + int(fields[12])) / self.CLOCK_TICKS
+
+
+def percentiles(samples) -> dict:
+    """
+    :param samples: list of latencies in seconds
+    :return: dict with p50 / p99 / p999 / max in milliseconds
+    """
+    if not samples:
+        return {"p50_ms": None, "p99_ms": None, "p999_ms": None, "max_ms": None}
+
+    samples = sorted(samples)
+
+    def at(fraction):
+        return round(samples[min(len(samples) - 1, int(fraction * len(samples)))] * 1000, 3)
+
+    return {"p50_ms": at(0.5), "p99_ms": at(0.99), "p999_ms": at(0.999), "max_ms": round(samples[-1] * 1000, 3)}
+
+
+async def gather_limited(coroutines, concurrency) -> list:
+    """
+    runs coroutines with at most concurrency of them at a time.
+    :param coroutines: iterable of coroutines
+    :param concurrency: int
+    :return: list of results (exceptions are returned, not raised)
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(limited(coroutine) for coroutine in coroutines), return_exceptions=True)
+
+
+async def connect_scenario(args, server) -> dict:
+    """
+    connect storm: opens --clients connections at once.
+    :param args: argparse namespace
+    :param server: ServerProcess or None
+    :return: result
+    """
+    loop = asyncio.get_event_loop()
+    clients = [BenchClient(loop, args.host, args.port, args.wire, args.compress) for _ in range(args.clients)]
+    rss_before = server.rss() if server else 0
+
+    start = time.perf_counter()
+    results = await gather_limited((client.connect(args.connect_timeout) for client in clients), args.concurrency)
+    duration = time.perf_counter() - start
+
+    connected = sum(1 for result in results if not isinstance(result, Exception))
+    failed = len(results) - connected
+    rss_after = server.rss() if server else 0
+
+    for client in clients:
+        client.close()
+
+    return {
+        "scenario": "connect",
+        "clients": args.clients,
+        "connected": connected,
+        "failed": failed,
+        "duration_s": round(duration, 3),
+        "connections_per_s": round(connected / duration, 1),
+        "rss_per_connection_bytes": round((rss_after - rss_before) / connected) if server and connected else None,
+    }
+
+
+async def churn_scenario(args, server) -> dict:
+    """
+    lobby churn: every client creates or joins a lobby and leaves it again, --rounds times.
+    :param args: argparse namespace
+    :param server: ServerProcess or None
+    :return: result
+    """
+    loop = asyncio.get_event_loop()
+
+    # a quarter of the rounds join a lobby that is held open by its creator
+    host_client = BenchClient(loop, args.host, args.port, args.wire, args.compress)
+    await host_client.connect(args.connect_timeout)
+    shared_lobby = f"bench-{next(lobby_ids)}"
+    await host_client.enter("!create", shared_lobby)
+
+    async def churn(client_id) -> int:
+        operations = 0
+        for round_id in range(args.rounds):
+            client = BenchClient(loop, args.host, args.port, args.wire, args.compress)
+            try:
+                await client.connect(args.connect_timeout)
+                if round_id % 4 == 3:
+                    await client.enter("!join", shared_lobby)
+                else:
+                    await client.enter("!create", f"bench-{next(lobby_ids)}-{client_id}")
+                await client.send("!exit")
+                operations += 1
+            finally:
+                client.close()
+        return operations
+
+    cpu_before = server.cpu_time() if server else 0
+    start = time.perf_counter()
+    results = await gather_limited((churn(client_id) for client_id in range(args.clients)), args.concurrency)
+    duration = time.perf_counter() - start
+    cpu = (server.cpu_time() - cpu_before) if server else None
+
+    host_client.close()
+    operations = sum(result for result in results if not isinstance(result, Exception))
+
+    return {
+        "scenario": "churn",
+        "clients": args.clients,
+        "rounds": args.rounds,
+        "operations": operations,
+        "errors": sum(1 for result in results if isinstance(result, Exception)),
+        "duration_s": round(duration, 3),
+        "operations_per_s": round(operations / duration, 1),
+        "cpu_ms_per_operation": round(cpu * 1000 / operations, 4) if cpu is not None and operations else None,
+    }
+
+
+async def chat_scenario(args, server) -> dict:
+    """
+    steady chat: --clients clients in rooms of --room-size, every client sends --messages chat lines.
+    The send time is the message text, receivers measure the fan-out latency.
+    :param args: argparse namespace
+    :param server: ServerProcess or None
+    :return: result
+    """
+    loop = asyncio.get_event_loop()
+    room_count = max(1, args.clients // args.room_size)
+    rooms = [[BenchClient(loop, args.host, args.port, args.wire, args.compress) for _ in range(args.room_size)]
+             for _ in range(room_count)]
+
+    async def fill(room) -> None:
+        await asyncio.gather(*(client.connect(args.connect_timeout) for client in room))
+        lobby_name = f"bench-{next(lobby_ids)}"
+        await room[0].enter("!create", lobby_name)
+        if not args.flood_control:
+            # the creator is the admin of the room, the load would be throttled by the default limits
+            await room[0].send(f"!set_flood chat {FLOOD_LIMIT} {FLOOD_LIMIT}")
+        await asyncio.gather(*(client.enter("!join", lobby_name) for client in room[1:]))
+
+    # rooms that couldn't be filled completely are left out
+    results = await gather_limited((fill(room) for room in rooms), max(1, args.concurrency // args.room_size))
+    for room, result in zip(rooms, results):
+        if isinstance(result, Exception):
+            for client in room:
+                client.close()
+    rooms = [room for room, result in zip(rooms, results) if not isinstance(result, Exception)]
+    clients = [client for room in rooms for client in room]
+
+    latencies = []
+    other_responses = 0     # responses without a send time (flood control replies with --flood-control, ...)
+    expected = args.messages * (args.room_size - 1)     # per client
+    interval = 1 / args.rate if args.rate else 0
+
+    async def sender(client) -> None:
+        for _ in range(args.messages):
+            await client.send(str(time.perf_counter()))
+            await asyncio.sleep(interval)
+
+    async def receiver(client) -> int:
+        nonlocal other_responses
+        received = 0
+        while received < expected:
+            response = await client.receive()
+            if response is None:
+                break
+            text = response.get("msg", "")
+            if not response.get("code") == 1 or " >> " not in text:
+                # only chat lines carry a send time
+                other_responses += 1
+                continue
+            received += 1
+            latencies.append(time.perf_counter() - float(text.rsplit(" >> ", 1)[1]))
+        return received
+
+    cpu_before = server.cpu_time() if server else 0
+    start = time.perf_counter()
+
+    receivers = [loop.create_task(receiver(client)) for client in clients]
+    await asyncio.gather(*(sender(client) for client in clients))
+    sent_duration = time.perf_counter() - start
+    done, pending = await asyncio.wait(receivers, timeout=args.timeout)
+    duration = time.perf_counter() - start
+    cpu = (server.cpu_time() - cpu_before) if server else None
+
+    for task in pending:
+        task.cancel()
+    for client in clients:
+        client.close()
+
+    sent = args.messages * len(clients)
+    received = len(latencies)
+
+    return {
+        "scenario": "chat",
+        "clients": len(clients),
+        "failed_rooms": room_count - len(rooms),
+        "room_size": args.room_size,
+        "messages_sent": sent,
+        "messages_received": received,
+        "messages_expected": expected * len(clients),
+        "other_responses": other_responses,
+        "duration_s": round(duration, 3),
+        "sent_per_s": round(sent / sent_duration, 1),
+        "received_per_s": round(received / duration, 1),
+        **percentiles(latencies),
+        "cpu_us_per_message": round(cpu * 1e6 / sent, 2) if cpu is not None and sent else None,
+    }
+
+
+async def run_benchmark(args, server) -> list:
+    """
+    runs the selected scenarios one after another.
+    :param args: argparse namespace
+    :param server: ServerProcess or None
+    :return: list of results
+    """
+    scenarios = {"connect": connect_scenario, "churn": churn_scenario, "chat": chat_scenario}
+    results = []
+    for name in args.scenarios.split(","):
+        result = await scenarios[name](args, server)
+        result["wire"] = args.wire
+        result["compress"] = args.compress
+        results.append(result)
+        print(json.dumps(result), flush=True)
+    return results
+
+
+def start_server(args) -> subprocess.Popen:
+    """
+    starts a server on a free port and waits until it accepts connections.
+    :param args: argparse namespace (port is set)
+    :return: subprocess.Popen
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind((args.host, 0))
+        args.port = probe.getsockname()[1]
+
+    limits = []
+    if not args.admission_control:
+        # every simulated client connects from the same address, --server-args still override this
+        limits = ["--connect-rate", "0", "--max-connections", "0", "--max-lobby-members", "0"]
+
+    process = subprocess.Popen([sys.executable, SERVER_SCRIPT, "--host", args.host, "--port", str(args.port), *limits,
+                                *args.server_args.split()],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection((args.host, args.port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("[start_server] the server didn't start.")
+
+
+def raise_file_limit() -> None:
+    """
+    thousands of clients need as many file descriptors as the system allows.
+    :return: -
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TCP group chat load generator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int,
+                        help="port of a running server, a local server is started without it")
+    parser.add_argument("--server-args", default="",
+                        help="extra arguments of the started server, e.g. '--workers 4'")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"comma separated list of {SCENARIOS}")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=256,
+                        help="most connection attempts / lobby operations in flight")
+    parser.add_argument("--rounds", type=int, default=5,
+                        help="churn: lobby operations per client")
+    parser.add_argument("--room-size", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=100,
+                        help="chat: messages per client")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="chat: messages per second per client (0 = as fast as possible)")
+    parser.add_argument("--connect-timeout", type=float, default=10,
+                        help="seconds a connection may take until the server greeted it")
+    parser.add_argument("--timeout", type=float, default=30,
+                        help="chat: seconds to wait for outstanding messages")
+    parser.add_argument("--wire", choices=wire.CODECS, default=wire.BINARY)
+    parser.add_argument("--compress", action="store_true",
+                        help="clients negotiate compression of the server's outbound stream")
+    parser.add_argument("--flood-control", action="store_true",
+                        help="chat: keeps the default flood control limits of the rooms")
+    parser.add_argument("--admission-control", action="store_true",
+                        help="keeps the default connection limits of the server started by the benchmark")
+    parser.add_argument("--output",
+                        help="appends the results as JSON lines to this file")
+    args = parser.parse_args()
+
+    for scenario in args.scenarios.split(","):
+        if scenario not in SCENARIOS:
+            parser.error(f"unknown scenario '{scenario}'")
+
+    raise_file_limit()
+
+    server_process = start_server(args) if args.port is None else None
+    try:
+        results = asyncio.run(run_benchmark(args, server_process and ServerProcess(server_process.pid)))
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait()
+
+    if args.output:
+        with open(args.output, "a") as output:
+            for result in results:
+                output.write(json.dumps(result) + "\n")
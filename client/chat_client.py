@@ -0,0 +1,299 @@
+import asyncio
+import random
+import socket
+import sys
+import os
+
+# shared protocol modules (framing, ...) live in ../common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+import framing
+import wire
+
+
+class ChatClient:
+    """
+    Asynchronous connection to a chat server.
+    Incoming responses are read by awaiting the socket (no polling), so an idle client uses no CPU
+    and thousands of clients can share one event loop.
+
+    async with ChatClient(host, port) as client:
+        await client.create("lobby")
+        await client.send("hello")
+        async for response in client:
+            print(response["msg"])
+
+    At most max_responses responses are buffered for receive(), the oldest ones are dropped (counted in dropped).
+    Clients that only send (bots) pass max_responses=0 and buffer nothing.
+    """
+    # Constant Variables
+    BUFFER = 1024
+    COMMAND_TIMEOUT = 10        # seconds join() / create() wait for the server
+    MAX_RESPONSES = 1000        # responses buffered for receive()
+    PASSWORD_QUERY = "Enter Lobby password:"
+    INVALID_PASSWORD = "Invalid password. Closing connection."
+
+    def __init__(self, host, port, codec=wire.BINARY, compress=True, max_responses=MAX_RESPONSES):
+        self.host = host
+        self.port = port
+        self.codec = codec          # preferred wire format, the server falls back to JSON
+        self.compress = compress    # asks the server to compress larger batches
+        self.max_responses = max_responses
+
+        # Dynamic Variables
+        self.sock = None
+        self.closed = False
+        self.error = None           # why the client closed the connection (malformed frame or response)
+        self.lobby = None           # lobby the client is in, None for the main lobby
+        self.dropped = 0            # responses dropped from the full buffer
+
+        # one extra slot keeps room for the end marker
+        self._responses = asyncio.Queue(max_responses + 1)
+        self._waiters = []          # tuples (predicate, future) of commands waiting for their response
+        self._send_lock = asyncio.Lock()
+        self._reader_task = None
+
+    async def connect(self) -> None:
+        """
+        connects to the server and negotiates the wire format.
+        :return: -
+        """
+        loop = asyncio.get_running_loop()
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        try:
+            await loop.sock_connect(self.sock, (self.host, self.port))
+        except OSError:
+            self.sock.close()
+            raise
+
+        reader = framing.FrameReader(loop, self.sock, self.BUFFER)
+        self._reader_task = loop.create_task(self._read(reader))
+        # frames are decoded by their first byte, so no reply is awaited.
+        await self.send(f"!wire {self.codec}")
+        if self.compress:
+            # the decoder understands compressed batches before the server may send any
+            reader.decoder.accept_compression()
+            await self.send("!compress")
+
+    async def _read(self, reader) -> None:
+        """
+        receives responses until the connection is closed.
+        A response that can't be decoded closes the connection, the reason is kept in self.error.
+        :param reader: framing.FrameReader
+        :return: -
+        """
+        try:
+            while (frame := await reader.read_frame()) is not None:
+                try:
+                    response = wire.decode_message(frame)
+                except ValueError as error:
+                    self.error = f"[ChatClient] invalid response: {error}"
+                    break
+
+                if response.get("code") == 6:
+                    # heartbeat of the server
+                    asyncio.get_running_loop().create_task(self._pong())
+                    continue
+
+                for waiter in list(self._waiters):
+                    predicate, future = waiter
+                    if not future.done() and predicate(response):
+                        future.set_result(response)
+                        self._waiters.remove(waiter)
+
+                if self.max_responses:
+                    self._buffer(response)
+        except OSError:
+            pass
+        finally:
+            self.closed = True
+            if self.error is None:
+                self.error = reader.error
+            if self.error is not None:
+                # the server can't be understood anymore, nothing it sends later is read
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            for _, future in self._waiters:
+                if not future.done():
+                    future.set_exception(ConnectionError(self.error or "[ChatClient] connection closed."))
+            self._waiters.clear()
+            # wakes up every consumer
+            self._responses.put_nowait(None)
+
+    def _buffer(self, response) -> None:
+        """
+        keeps a response for receive(), the oldest one is dropped once max_responses are buffered.
+        :param response: dict
+        :return: -
+        """
+        if self._responses.qsize() >= self.max_responses:
+            self._responses.get_nowait()
+            self.dropped += 1
+        self._responses.put_nowait(response)
+
+    async def send(self, text) -> None:
+        """
+        sends a chat message or a command.
+        :param text: str
+        :return: -
+        """
+        if self.closed:
+            raise ConnectionError("[ChatClient] connection closed.")
+        async with self._send_lock:
+            await asyncio.get_running_loop().sock_sendall(self.sock, framing.encode_frame(text.encode()))
+
+    async def _pong(self) -> None:
+        """
+        answers a ping of the server.
+        :return: -
+        """
+        try:
+            await self.send("!pong")
+        except (ConnectionError, OSError):
+            pass
+
+    async def command(self, text, predicate, timeout=COMMAND_TIMEOUT) -> dict:
+        """
+        sends a command and waits for the response it matches (every response still reaches receive()).
+        :param text: command
+        :param predicate: callable(response) -> True for the response of the command
+        :param timeout: seconds
+        :return: response
+        """
+        future = asyncio.get_running_loop().create_future()
+        waiter = (predicate, future)
+        self._waiters.append(waiter)
+        try:
+            await self.send(text)
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    async def _enter(self, command, lobby_name, password=None) -> dict:
+        """
+        :param command: '!join' or '!create'
+        :param lobby_name: str
+        :param password: answer to the password query of a protected lobby
+        :return: response (code 1: joined, the password query or the invalid password reply,
+                 code 2: lobby is on another server, code 3: failed)
+        """
+        success = f"You successfully connected to {lobby_name}"
+
+        def answers(response) -> bool:
+            return (response.get("code") in (2, 3)
+                    or response.get("msg") in (success, self.PASSWORD_QUERY, self.INVALID_PASSWORD))
+
+        response = await self.command(f"{command} {lobby_name}", answers)
+        if response.get("msg") == self.PASSWORD_QUERY and password is not None:
+            response = await self.command(password, answers)
+        if response.get("msg") == success:
+            self.lobby = lobby_name
+        return response
+
+    async def join(self, lobby_name, password=None) -> dict:
+        """
+        joins a lobby and waits until the client is a member.
+        Without a password a protected lobby returns its password query, send() the password to answer it.
+        :param lobby_name: str
+        :param password: optional password of the lobby
+        :return: response (code 1: joined, the password query or the invalid password reply,
+                 code 2: lobby is on another server, code 3: failed)
+        """
+        return await self._enter("!join", lobby_name, password)
+
+    async def create(self, lobby_name) -> dict:
+        """
+        creates a lobby and waits until the client is a member.
+        :param lobby_name: str
+        :return: response (code 1: joined, code 3: failed)
+        """
+        return await self._enter("!create", lobby_name)
+
+    async def receive(self) -> dict | None:
+        """
+        waits for the next response of the server.
+        :return: response or None once the connection is closed
+        """
+        response = await self._responses.get()
+        if response is None:
+            # keeps the end marker for the next call
+            self._responses.put_nowait(None)
+        return response
+
+    def drain(self) -> list:
+        """
+        takes the responses that already arrived without waiting.
+        :return: list of responses
+        """
+        responses = []
+        while not self._responses.empty():
+            response = self._responses.get_nowait()
+            if response is None:
+                self._responses.put_nowait(None)
+                break
+            responses.append(response)
+        return responses
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> dict:
+        response = await self.receive()
+        if response is None:
+            raise StopAsyncIteration
+        return response
+
+    async def close(self) -> None:
+        """
+        closes the connection (without sending !exit).
+        :return: -
+        """
+        if self.sock is None:
+            return
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        if self._reader_task is not None:
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+        self.sock.close()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+async def open_client(host, port, codec=wire.BINARY, attempts=5, retry_delay=0.1, max_retry_delay=5,
+                      compress=True, max_responses=ChatClient.MAX_RESPONSES) -> ChatClient:
+    """
+    connects a ChatClient, failed attempts are retried with a jittered exponential backoff.
+    :param host: str
+    :param port: int
+    :param codec: preferred wire format
+    :param attempts: connection attempts before giving up
+    :param retry_delay: seconds before the first retry
+    :param max_retry_delay: longest delay between two attempts
+    :param compress: asks the server to compress larger batches
+    :param max_responses: responses buffered for receive() (0: none)
+    :return: connected ChatClient
+    """
+    delay = retry_delay
+    for attempt in range(attempts):
+        client = ChatClient(host, port, codec, compress, max_responses)
+        try:
+            await client.connect()
+            return client
+        except OSError as error:
+            if attempt == attempts - 1:
+                raise ConnectionError(f"[open_client] couldn't connect to {host}:{port}: {error}")
+        # the jitter keeps clients that lost the same server from reconnecting in lockstep
+        await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+        delay = min(delay * 2, max_retry_delay)
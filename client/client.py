@@ -1,12 +1,21 @@
 import asyncio
-import socket
-import json
+import sys
+import os
+
+# shared protocol modules (framing, ...) live in ../common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+import chat_client
+import wire
 
 
 class ConnectionData:
     HOST = "192.168.115.200"
     PORT = 8888
     BUFFER = 1024
+    WIRE = wire.BINARY      # preferred wire format, the server falls back to JSON
+    LOBBY = None            # lobby to join right after connecting (set by a cluster redirect)
+    CLIENT = None           # chat_client.ChatClient of the current server
 
 
 change_server_event = asyncio.Event()
@@ -38,9 +47,9 @@ def handle_response(response, stop_event) -> None:
 
                 connection_data.HOST = lobby_host
                 connection_data.PORT = lobby_port
+                connection_data.LOBBY = response.get('lobby')
 
                 change_server_event.set()
-                stop_event.set()
             case 3:
                 # Client side error - Not Found
                 pass
@@ -50,43 +59,55 @@ def handle_response(response, stop_event) -> None:
             case 5:
                 # Close connection
                 stop_event.set()
+            case 6:
+                # Ping, answered by chat_client.ChatClient
+                pass
     except KeyError:
         pass
         # print("[handle_response] incorrect response.")
 
 
-async def receiver(client, stop_event) -> None:
+async def switch_server() -> None:
     """
-    handles incoming data from the server.
-    :param client: socket client object
-    :param stop_event: asyncio.Event()
+    moves to the server set by a code-2 response without leaving the event loop.
+    The new connection is opened (and the lobby joined) before the old one is closed,
+    responses that arrived on the old connection in the meantime are still shown.
     :return: -
     """
-    def receive() -> str:
-        """
-        receives full transmission from the server.
-        :return: str
-        """
-        data = b""
-        while True:
-            recv_data = client.recv(connection_data.BUFFER)
-            data += recv_data
-            # Breaks the loop after receiving data smaller than the buffer
-            if len(recv_data) < connection_data.BUFFER:
-                break
-        return data.decode()
+    old_client = connection_data.CLIENT
+    change_server_event.clear()
+
+    print(f"[switch_server] connecting to {connection_data.HOST} on port {connection_data.PORT}.")
+    new_client = await chat_client.open_client(connection_data.HOST, connection_data.PORT, connection_data.WIRE)
+    if connection_data.LOBBY is not None:
+        await new_client.send(f"!join {connection_data.LOBBY}")
+        connection_data.LOBBY = None
 
+    connection_data.CLIENT = new_client
+    await old_client.close()
+    for response in old_client.drain():
+        if response['code'] == 1:
+            print(response['msg'])
+
+
+async def receiver(stop_event) -> None:
+    """
+    handles incoming data from the server (follows server changes).
+    :param stop_event: asyncio.Event()
+    :return: -
+    """
     try:
         while not stop_event.is_set():
-            try:
-                command_map = json.loads(receive())
-                handle_response(command_map, stop_event)
-            except BlockingIOError:
-                await asyncio.sleep(0)
-                continue
-            except json.JSONDecodeError:
-                print("[receiver] Invalid format.")
-                continue
+            async for response in connection_data.CLIENT:
+                handle_response(response, stop_event)
+                if stop_event.is_set() or change_server_event.is_set():
+                    break
+
+            if change_server_event.is_set():
+                await switch_server()
+            else:
+                # server closed the connection
+                stop_event.set()
     except asyncio.CancelledError:
         print("[receiver] stopping receiver task.")
     except Exception as e:
@@ -94,25 +115,21 @@ async def receiver(client, stop_event) -> None:
         raise
 
 
-async def sender(client, stop_event):
+async def sender(stop_event):
     """
-    sends user input to the server.
-    :param client: socket client object
+    sends user input to the server (always the current one).
     :param stop_event: asyncio.Event()
     :return: -
     """
 
     try:
         while not stop_event.is_set():
-            # small sleep to prevent busy looping
-            await asyncio.sleep(0.1)
-
             try:
                 msg = await asyncio.to_thread(input)
-                client.send(msg.encode())
+                await connection_data.CLIENT.send(msg)
                 if msg == "!exit":
                     stop_event.set()
-            except EOFError:
+            except (EOFError, ConnectionError):
                 stop_event.set()
     except asyncio.CancelledError:
         print("[sender] stopping sender task.")
@@ -121,16 +138,20 @@ async def sender(client, stop_event):
         raise
 
 
-async def handle_client(client):
+async def handle_client():
     """
     function to handle asynchronous sending and receiving tasks.
-    :param client: socket client object
+    One event loop serves the client across every server change.
     :return: -
     """
     stop_event = asyncio.Event()
 
-    receive = asyncio.create_task(receiver(client, stop_event))
-    send = asyncio.create_task(sender(client, stop_event))
+    print(f"[handle_client] connecting to {connection_data.HOST} on port {connection_data.PORT}.")
+    connection_data.CLIENT = await chat_client.open_client(connection_data.HOST, connection_data.PORT,
+                                                           connection_data.WIRE)
+
+    receive = asyncio.create_task(receiver(stop_event))
+    send = asyncio.create_task(sender(stop_event))
 
     try:
         await asyncio.wait([receive, send], return_when=asyncio.FIRST_COMPLETED)
@@ -141,36 +162,17 @@ async def handle_client(client):
         receive.cancel()
         send.cancel()
         await asyncio.gather(receive, send, return_exceptions=True)
+        await connection_data.CLIENT.close()
         print("[handle_client] successfully stopped the send and receive coroutines.")
 
 
-def start_client():
-    """
-    Prepares the client for server connection.
-    :return:
-    """
-    # clear asyncio event
-    change_server_event.clear()
-
-    print(f"[start_client] connecting to {connection_data.HOST} on port {connection_data.PORT}.")
+def client_loop():
     try:
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client.connect((connection_data.HOST, connection_data.PORT))
-        client.setblocking(False)
-        asyncio.run(handle_client(client))
-        client.close()
+        asyncio.run(handle_client())
     except Exception as e:
-        print(f"[start_client] Unexpected error: {e}")
+        print(f"[client_loop] Unexpected error: {e}")
         raise
 
 
-def client_loop():
-    change_server_event.set()
-
-    while change_server_event.is_set():
-        start_client()
-
-
 if __name__ == '__main__':
     client_loop()
-
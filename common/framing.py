@@ -0,0 +1,190 @@
+import struct
+import collections
+import time
+import zlib
+
+
+"""
+Length-prefixed framing shared by the server and the client.
+
+Every frame on the wire looks like this:
++----------------------+---------------------+
+| length (4 bytes, BE) | payload (length B)  |
++----------------------+---------------------+
+
+Compressed batches (negotiated with !compress) set the highest bit of the length.
+Their payload is the next piece of the connection's zlib stream (sync flushed),
+it decompresses to one or more complete frames.
+"""
+
+HEADER = struct.Struct("!I")
+HEADER_SIZE = HEADER.size
+
+BUFFER = 64 * 1024                  # size of the reusable receive buffer
+MAX_FRAME_SIZE = 1024 * 1024        # frames larger than this are treated as a protocol error
+COMPRESSED = 0x80000000             # length flag of a compressed batch
+
+traffic_counters = collections.Counter()    # bytes_received / frames_received of all FrameReaders
+
+
+class FrameError(Exception):
+    def __init__(self, error_message):
+        self.error_message = error_message
+        super().__init__(self.error_message)
+
+
+def encode_compressed(data) -> bytes:
+    """
+    Prefixes a piece of compressed stream with its length and the compressed flag.
+    :param data: bytes (output of a zlib compressor, ending with a sync flush)
+    :return: bytes
+    """
+    return HEADER.pack(len(data) | COMPRESSED) + data
+
+
+def encode_frame(payload) -> bytes:
+    """
+    Prefixes the payload with its length.
+    :param payload: bytes
+    :return: bytes
+    """
+    return HEADER.pack(len(payload)) + payload
+
+
+class FrameDecoder:
+    """
+    Incremental decoder. Bytes are fed in as they arrive and every complete frame is returned,
+    no matter how the stream was split or merged by the network.
+    """
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+        self._decompressor = None       # zlib stream of compressed batches, created by accept_compression()
+        self._inner = None              # decodes the frames inside compressed batches
+
+    def accept_compression(self) -> None:
+        """
+        allows compressed batches (call before compression is negotiated).
+        :return: -
+        """
+        if self._decompressor is None:
+            self._decompressor = zlib.decompressobj()
+            self._inner = FrameDecoder(self.max_frame_size)
+
+    def feed(self, data) -> list:
+        """
+        Appends data to the internal buffer and extracts all complete frames.
+        :param data: bytes-like object
+        :return: list of payloads (bytes)
+        """
+        buffer = self._buffer
+        buffer += data
+
+        frames = []
+        offset = 0
+        buffered = len(buffer)
+
+        while buffered - offset >= HEADER_SIZE:
+            (length,) = HEADER.unpack_from(buffer, offset)
+            compressed = length & COMPRESSED
+            length &= ~COMPRESSED
+            if length > self.max_frame_size:
+                raise FrameError(f"[FrameDecoder] frame of {length} bytes exceeds the limit of {self.max_frame_size}.")
+
+            end = offset + HEADER_SIZE + length
+            if end > buffered:
+                # frame is not complete yet
+                break
+            if compressed:
+                if self._decompressor is None:
+                    raise FrameError("[FrameDecoder] received a compressed batch without negotiating compression.")
+                frames += self._inner.feed(self._decompressor.decompress(buffer[offset + HEADER_SIZE:end]))
+            else:
+                frames.append(bytes(buffer[offset + HEADER_SIZE:end]))
+            offset = end
+
+        # drops consumed bytes once per call instead of once per frame
+        if offset:
+            del buffer[:offset]
+        return frames
+
+    def pending(self) -> int:
+        """
+        :return: number of buffered bytes that do not form a complete frame yet.
+        """
+        return len(self._buffer)
+
+    def buffered(self) -> bytes:
+        """
+        :return: the buffered bytes that do not form a complete frame yet.
+        """
+        return bytes(self._buffer)
+
+
+class FrameReader:
+    """
+    Reads frames from a non-blocking socket through the event loop.
+    The receive buffer is allocated once and reused for every recv call.
+    """
+    def __init__(self, loop, sock, buffer_size=BUFFER):
+        self.loop = loop
+        self.sock = sock
+        self.decoder = FrameDecoder()
+        self.frames = collections.deque()
+        self.last_received = time.monotonic()   # time of the last recv (heartbeats)
+        self.error = None                       # why the stream was rejected (malformed frame or text)
+
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+
+    async def read_frame(self) -> bytes | None:
+        """
+        Waits for the next complete frame.
+        :return: payload (bytes) or None if the peer closed the connection or sent a malformed frame (error).
+        """
+        while not self.frames:
+            if self.error is not None:
+                return None
+            try:
+                received = await self.loop.sock_recv_into(self.sock, self._buffer)
+            except ConnectionError:
+                # a reset connection is handled like a closed one
+                return None
+            if received == 0:
+                return None
+            self.last_received = time.monotonic()
+            try:
+                frames = self.decoder.feed(self._view[:received])
+            except (FrameError, zlib.error) as error:
+                # the rest of the stream can't be decoded anymore, the connection is handled like a closed one
+                self._reject(error)
+                return None
+            self.frames.extend(frames)
+
+            traffic_counters["bytes_received"] += received
+            traffic_counters["frames_received"] += len(frames)
+        return self.frames.popleft()
+
+    async def read_text(self) -> str | None:
+        """
+        Waits for the next complete frame and decodes it.
+        :return: str or None if the peer closed the connection or sent a malformed frame (error).
+        """
+        frame = await self.read_frame()
+        if frame is None:
+            return None
+        try:
+            return frame.decode()
+        except UnicodeDecodeError as error:
+            self._reject(error)
+            return None
+
+    def _reject(self, error) -> None:
+        """
+        stops reading after a protocol error, the caller logs self.error and closes the connection.
+        :param error: FrameError, zlib.error or UnicodeDecodeError
+        :return: -
+        """
+        self.error = str(error)
+        self.frames.clear()
+        traffic_counters["protocol_errors"] += 1
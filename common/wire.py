@@ -0,0 +1,125 @@
+import struct
+import json
+
+
+"""
+Message encodings carried inside a frame (see framing.py).
+
+json   : the response dictionary serialized with json.dumps (default).
+binary : compact struct header followed by a UTF-8 body.
+         +---------------+----------------+------------------+
+         | code (1 byte) | flags (1 byte) | body (UTF-8)     |
+         +---------------+----------------+------------------+
+         The length of the body is given by the frame length prefix.
+         flags:
+            CONNECTION -> body is 'host port' and decodes into the 'connection' field (code 2).
+            otherwise  -> body decodes into the 'msg' field.
+
+The encoding of a frame is detected by its first byte: JSON always starts with '{',
+binary frames start with the response code, so both can be mixed on one connection.
+"""
+
+JSON = "json"
+BINARY = "binary"
+
+CODECS = (JSON, BINARY)
+
+BINARY_HEADER = struct.Struct("!BB")
+
+FLAG_CONNECTION = 0x01
+
+_JSON_MARKER = ord("{")
+
+
+def _binary_body(response) -> tuple | None:
+    """
+    maps a response onto flags and body of the binary encoding.
+    :param response: dict
+    :return: tuple (flags, body) or None if the response can't be expressed in binary
+    """
+    fields = response.keys() - {'code', 'host'}
+
+    if not fields:
+        return 0, b""
+    if fields == {'msg'}:
+        return 0, str(response['msg']).encode()
+    if fields == {'connection'}:
+        host, port = response['connection']
+        return FLAG_CONNECTION, f"{host} {port}".encode()
+    return None
+
+
+def encode_message(response, codec=JSON) -> bytes:
+    """
+    serializes a response dictionary.
+    Responses that don't fit into the binary encoding fall back to JSON.
+    :param response: dict generated by server_response.generate_response
+    :param codec: JSON or BINARY
+    :return: bytes (frame payload)
+    """
+    if codec == BINARY and 0 <= response['code'] < _JSON_MARKER:
+        binary = _binary_body(response)
+        if binary is not None:
+            flags, body = binary
+            return BINARY_HEADER.pack(response['code'], flags) + body
+    return json.dumps(response).encode()
+
+
+def message_template(code, host, codec=JSON) -> tuple:
+    """
+    splits the encoding of a text message (code, host, msg) around the text itself,
+    so both parts can be cached and only the text has to be encoded per message.
+    :param code: int
+    :param host: str
+    :param codec: JSON or BINARY
+    :return: tuple (prefix, suffix) -> payload = prefix + encode_text(msg, codec) + suffix
+    """
+    if codec == BINARY:
+        return BINARY_HEADER.pack(code, 0), b""
+
+    # '{"code": 1, "host": "..."}' -> '{"code": 1, "host": "...", "msg": ' + text + '}'
+    head = json.dumps({'code': code, 'host': host})
+    return (head[:-1] + ', "msg": ').encode(), b"}"
+
+
+def encode_text(text, codec=JSON) -> bytes:
+    """
+    encodes the text of a message for the given codec (see message_template).
+    :param text: str
+    :param codec: JSON or BINARY
+    :return: bytes
+    """
+    if codec == BINARY:
+        return text.encode()
+    return json.dumps(text).encode()
+
+
+def decode_message(payload) -> dict:
+    """
+    deserializes a frame payload of either encoding.
+    :param payload: bytes
+    :return: dict
+    :raises ValueError: if the payload is not a valid message
+    """
+    if not payload:
+        raise ValueError("[decode_message] empty message.")
+
+    if payload[0] == _JSON_MARKER:
+        return json.loads(payload)
+
+    if len(payload) < BINARY_HEADER.size:
+        raise ValueError("[decode_message] truncated binary header.")
+
+    code, flags = BINARY_HEADER.unpack_from(payload)
+    body = bytes(payload[BINARY_HEADER.size:]).decode()
+
+    response = {
+        'code': code,
+        'host': None,
+    }
+    if flags & FLAG_CONNECTION:
+        host, port = body.rsplit(" ", 1)
+        response['connection'] = [host, int(port)]
+    else:
+        response['msg'] = body
+    return response
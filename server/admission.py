@@ -0,0 +1,107 @@
+import ratelimit
+
+import collections
+import time
+
+
+"""
+ADMISSION CONTROL
+Decides right after accept() whether a new connection is served, before any session state exists.
+Rejected connections get a single pre-encoded response (code 5) and are closed at once.
+
+server_full : the process already serves max_connections clients.
+rate_limit  : the address opened more than connect_rate connections per second (token bucket, connect_burst).
+lobby_full  : !join of a lobby that has max_lobby_members members (checked by the server, not at accept).
+
+A limit of 0 turns that check off.
+"""
+
+SERVER_FULL = "server_full"
+RATE_LIMIT = "rate_limit"
+LOBBY_FULL = "lobby_full"
+
+admission_counters = collections.Counter()      # reason -> rejected connections / joins
+
+
+class AdmissionControl:
+    """
+    Connection limits of one server process.
+    """
+    # Constant Variables
+    MAX_CONNECTIONS = 10000
+    MAX_LOBBY_MEMBERS = 1000
+    CONNECT_RATE = 20           # new connections per second and address
+    CONNECT_BURST = 50
+    MAX_TRACKED = 65536         # addresses with a bucket before full buckets are dropped
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, max_lobby_members=MAX_LOBBY_MEMBERS,
+                 connect_rate=CONNECT_RATE, connect_burst=CONNECT_BURST):
+        self.max_connections = max_connections
+        self.max_lobby_members = max_lobby_members
+        self.connect_limit = ratelimit.RateLimit(connect_rate, connect_burst) if connect_rate else None
+
+        # Dynamic Variables
+        self.buckets = {}       # address -> list [tokens, last refill]
+
+    def admit(self, address, connections, now=None) -> str | None:
+        """
+        :param address: ip address of the new connection
+        :param connections: number of connections the process already serves
+        :param now: optional time.monotonic()
+        :return: None to serve the connection, otherwise the reason for rejecting it
+        """
+        if self.max_connections and connections >= self.max_connections:
+            reason = SERVER_FULL
+        elif self.connect_limit is not None and not self._take(address, now):
+            reason = RATE_LIMIT
+        else:
+            return None
+
+        admission_counters[reason] += 1
+        return reason
+
+    def admit_member(self, members) -> bool:
+        """
+        :param members: current members of the lobby (all processes)
+        :return: False if the lobby is full
+        """
+        if self.max_lobby_members and members >= self.max_lobby_members:
+            admission_counters[LOBBY_FULL] += 1
+            return False
+        return True
+
+    def _take(self, address, now=None) -> bool:
+        """
+        takes a token from the bucket of an address.
+        :param address: str
+        :param now: optional time.monotonic()
+        :return: False if the bucket is empty
+        """
+        if now is None:
+            now = time.monotonic()
+        limit = self.connect_limit
+
+        bucket = self.buckets.get(address)
+        if bucket is None:
+            if len(self.buckets) >= self.MAX_TRACKED:
+                self._prune(now)
+            bucket = self.buckets[address] = [limit.burst, now]
+        else:
+            bucket[0] = min(limit.burst, bucket[0] + (now - bucket[1]) * limit.rate)
+            bucket[1] = now
+
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def _prune(self, now) -> None:
+        """
+        drops the buckets that refilled completely, they behave like a new bucket.
+        :param now: time.monotonic()
+        :return: -
+        """
+        limit = self.connect_limit
+        for address in [address for address, (tokens, last) in self.buckets.items()
+                        if tokens + (now - last) * limit.rate >= limit.burst]:
+            del self.buckets[address]
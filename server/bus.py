@@ -0,0 +1,280 @@
+import framing
+import log
+import outbound
+
+import abc
+import asyncio
+import json
+import socket
+
+
+"""
+LOCAL BROADCAST BUS
+Worker processes (server.py --workers N) are connected through a hub in the parent process
+over a Unix domain socket. Every message is a framed JSON object:
+
+members  : {"op": "members", "lobby": name, "worker": id, "count": n}   local member count of a worker
+password : {"op": "password", "lobby": name, "worker": id, "password": p}
+message  : {"op": "message", "lobby": name, "worker": id, "msg": text}  chat line for all members
+kickall  : {"op": "kickall", "lobby": name, "worker": id}
+
+members and password updates replicate the lobby directory and are relayed to every worker,
+message and kickall are only relayed to workers that have members in the lobby.
+"""
+
+logger = log.get_logger("bus")
+
+MEMBERS = "members"
+PASSWORD = "password"
+MESSAGE = "message"
+KICKALL = "kickall"
+HELLO = "hello"
+
+DIRECTORY_OPS = (MEMBERS, PASSWORD)
+
+
+def encode_message(message) -> bytes:
+    """
+    :param message: dict
+    :return: bytes (frame)
+    """
+    return framing.encode_frame(json.dumps(message).encode())
+
+
+class LobbyState:
+    """
+    Replicated state of one lobby across all workers.
+    """
+    __slots__ = ("members", "password")
+
+    def __init__(self):
+        self.members = {}       # worker id -> member count
+        self.password = ""
+
+
+class BusState:
+    """
+    Lobby directory shared by all workers, updated by applying bus messages.
+    """
+    def __init__(self):
+        self.lobbies = {}       # lobby name -> LobbyState
+
+    def apply(self, message) -> None:
+        """
+        applies a directory message.
+        :param message: dict
+        :return: -
+        """
+        match message["op"]:
+            case "members":
+                state = self.lobbies.setdefault(message["lobby"], LobbyState())
+                if message["count"]:
+                    state.members[message["worker"]] = message["count"]
+                else:
+                    state.members.pop(message["worker"], None)
+                if not state.members:
+                    del self.lobbies[message["lobby"]]
+            case "password":
+                state = self.lobbies.get(message["lobby"])
+                if state is not None:
+                    state.password = message["password"]
+
+    def snapshot(self) -> list:
+        """
+        :return: list of messages that rebuild the current directory.
+        """
+        messages = []
+        for name, state in self.lobbies.items():
+            for worker, count in state.members.items():
+                messages.append({"op": MEMBERS, "lobby": name, "worker": worker, "count": count})
+            messages.append({"op": PASSWORD, "lobby": name, "worker": None, "password": state.password})
+        return messages
+
+    def workers_of(self, lobby_name) -> list:
+        """
+        :param lobby_name: str
+        :return: ids of the workers with members in that lobby.
+        """
+        state = self.lobbies.get(lobby_name)
+        return [] if state is None else list(state.members)
+
+
+class BusHub:
+    """
+    Runs in the parent process and relays messages between the workers.
+    """
+    def __init__(self, server_sock):
+        self.server_sock = server_sock
+        self.state = BusState()
+        self.workers = {}       # worker id -> outbound.ClientWriter
+
+    async def serve(self) -> None:
+        """
+        accepts worker connections forever.
+        :return: -
+        """
+        loop = asyncio.get_event_loop()
+        self.server_sock.setblocking(False)
+
+        while True:
+            worker_sock, _ = await loop.sock_accept(self.server_sock)
+            loop.create_task(self.handle_worker(loop, worker_sock))
+
+    async def handle_worker(self, loop, worker_sock) -> None:
+        """
+        registers a worker and relays everything it publishes.
+        :param loop: current event loop
+        :param worker_sock: socket
+        :return: -
+        """
+        reader = framing.FrameReader(loop, worker_sock)
+        writer = outbound.ClientWriter(loop, worker_sock, flush_window=0)
+        writer.start()
+
+        hello = await reader.read_frame()
+        if hello is None:
+            worker_sock.close()
+            return
+        worker_id = json.loads(hello)["worker"]
+        self.workers[worker_id] = writer
+
+        # brings the new worker up to date
+        for message in self.state.snapshot():
+            writer.send(encode_message(message))
+
+        while (frame := await reader.read_frame()) is not None:
+            message = json.loads(frame)
+            self.relay(message, frame)
+
+        # a worker that is gone has no members anymore
+        del self.workers[worker_id]
+        for lobby_name in [name for name, state in self.state.lobbies.items() if worker_id in state.members]:
+            gone = {"op": MEMBERS, "lobby": lobby_name, "worker": worker_id, "count": 0}
+            self.relay(gone, json.dumps(gone).encode())
+
+        await writer.close()
+        worker_sock.close()
+
+    def relay(self, message, payload) -> None:
+        """
+        forwards a message to the workers that need it.
+        :param message: dict
+        :param payload: bytes (the encoded message)
+        :return: -
+        """
+        if message["op"] in DIRECTORY_OPS:
+            self.state.apply(message)
+            receivers = self.workers.keys()
+        else:
+            receivers = self.state.workers_of(message["lobby"])
+
+        frame = framing.encode_frame(payload)
+        for worker_id in receivers:
+            if not worker_id == message["worker"] and worker_id in self.workers:
+                self.workers[worker_id].send(frame)
+
+
+class BusEndpoint(abc.ABC):
+    """
+    Base of everything that publishes lobby events to other processes (bus.BusClient, cluster.ClusterNode).
+    Keeps the replicated lobby directory and answers the questions a Lobby asks about remote members.
+    """
+    def __init__(self, worker_id, handler):
+        self.worker_id = worker_id
+        self.handler = handler      # callable(message) for messages of other processes
+        self.state = BusState()
+
+    @abc.abstractmethod
+    def publish(self, op, lobby_name, **fields) -> None:
+        """
+        sends a lobby event to the other processes.
+        :param op: MEMBERS, PASSWORD, MESSAGE or KICKALL
+        :param lobby_name: str
+        :return: -
+        """
+
+    def receive(self, message) -> None:
+        """
+        applies a message of another process and hands it to the handler.
+        :param message: dict
+        :return: -
+        """
+        if message["op"] in DIRECTORY_OPS:
+            self.state.apply(message)
+        self.handler(message)
+
+    def remote_members(self, lobby_name) -> int:
+        """
+        :param lobby_name: str
+        :return: number of members connected to other processes.
+        """
+        state = self.state.lobbies.get(lobby_name)
+        if state is None:
+            return 0
+        return sum(count for worker, count in state.members.items() if not worker == self.worker_id)
+
+    def password(self, lobby_name) -> str:
+        """
+        :param lobby_name: str
+        :return: replicated password of the lobby ("" if none)
+        """
+        state = self.state.lobbies.get(lobby_name)
+        return "" if state is None else state.password
+
+    def route(self, lobby_name) -> tuple | None:
+        """
+        :param lobby_name: str
+        :return: tuple (host, port) of the server a client should be redirected to, None to join locally
+        """
+        return None
+
+
+class BusClient(BusEndpoint):
+    """
+    Connection of a worker to the hub. Published messages are applied locally first,
+    received messages are applied and handed to the handler callback.
+    """
+    def __init__(self, worker_id, path, handler):
+        super().__init__(worker_id, handler)
+        self.path = path
+
+        self.writer = None
+
+    async def connect(self) -> None:
+        """
+        connects to the hub and starts receiving.
+        :return: -
+        """
+        loop = asyncio.get_event_loop()
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        await loop.sock_connect(sock, self.path)
+
+        self.writer = outbound.ClientWriter(loop, sock, flush_window=0)
+        self.writer.start()
+        self.writer.send(encode_message({"op": HELLO, "worker": self.worker_id}))
+
+        loop.create_task(self._run(framing.FrameReader(loop, sock)))
+
+    def publish(self, op, lobby_name, **fields) -> None:
+        """
+        sends a message to the other workers.
+        :param op: MEMBERS, PASSWORD, MESSAGE or KICKALL
+        :param lobby_name: str
+        :return: -
+        """
+        message = {"op": op, "lobby": lobby_name, "worker": self.worker_id, **fields}
+        if op in DIRECTORY_OPS:
+            self.state.apply(message)
+        self.writer.send(encode_message(message))
+
+    async def _run(self, reader) -> None:
+        """
+        receives messages from the hub.
+        :param reader: framing.FrameReader
+        :return: -
+        """
+        while (frame := await reader.read_frame()) is not None:
+            self.receive(json.loads(frame))
+        logger.warning("bus_lost", worker=self.worker_id)
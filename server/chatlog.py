@@ -0,0 +1,290 @@
+import log
+
+import collections
+import mmap
+import os
+import struct
+import threading
+import time
+
+
+"""
+CHAT LOG
+Chat messages of all lobbies are appended to segment files (00000001.log, 00000002.log, ...) in the log directory.
+A background thread group-commits them: everything queued since the last commit is written with a single write
+and made durable with a single fsync, the event loop only appends to a list.
+
+record : header (payload length, timestamp, length of the lobby name) | lobby name | message   (utf-8)
+
+The lobby name of a record is the lobby instance (lobby.Lobby.instance: name@creation time), so a lobby created
+later under the same name never sees the transcript of an earlier one. A handed over lobby keeps its instance.
+
+Every segment keeps a sparse index in memory (rebuilt from the files at startup):
+lobby name -> offset of every INDEX_STRIDE-th record of that lobby, so reading the last n messages of a lobby
+only scans the mmap-ed segment from the closest indexed record up to the last record of the lobby.
+A read returns at most MAX_HISTORY messages and MAX_HISTORY_BYTES bytes, the oldest ones are left out.
+"""
+
+logger = log.get_logger("chatlog")
+
+RECORD = struct.Struct("!IdH")
+
+
+class Segment:
+    """
+    One append-only log file and its sparse index.
+    """
+    __slots__ = ("path", "size", "counts", "index")
+
+    def __init__(self, path):
+        self.path = path
+        self.size = 0           # committed bytes, readers never look beyond it
+        self.counts = {}        # lobby name -> number of records in this segment
+        self.index = {}         # lobby name -> list of offsets (record 0, INDEX_STRIDE, 2 * INDEX_STRIDE, ...)
+
+    def add(self, lobby_name, offset) -> None:
+        """
+        indexes a record that was written at that offset.
+        :param lobby_name: str
+        :param offset: int
+        :return: -
+        """
+        count = self.counts.get(lobby_name, 0)
+        if count % ChatLog.INDEX_STRIDE == 0:
+            self.index.setdefault(lobby_name, []).append(offset)
+        self.counts[lobby_name] = count + 1
+
+
+class ChatLog:
+    """
+    Durable transcript of all lobbies of this process.
+    append() can be called from the event loop, it never blocks on disk I/O.
+    """
+    # Constant Variables
+    SEGMENT_BYTES = 64 * 1024 * 1024    # a new segment is started once a segment exceeds this size
+    COMMIT_WINDOW = 0.005               # seconds messages are collected before a commit
+    INDEX_STRIDE = 64                   # records of a lobby between two index entries
+    MAX_HISTORY = 1000                  # most messages returned by one read
+    MAX_HISTORY_BYTES = 256 * 1024      # most message bytes returned by one read
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, commit_window=COMMIT_WINDOW):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.commit_window = commit_window
+
+        # Dynamic Variables
+        self.segments = []                      # list of Segment, the last one is written
+        self.pending = []                       # contains tuples (timestamp, lobby name, message)
+        self.closing = False
+
+        self._lock = threading.Lock()           # guards the segments and their indexes
+        self._condition = threading.Condition()  # guards pending and closing
+        self._file = None
+        self._thread = None
+
+    def open(self) -> None:
+        """
+        indexes the existing segments and starts the writer thread.
+        :return: -
+        """
+        os.makedirs(self.directory, exist_ok=True)
+
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith(".log"):
+                self.segments.append(self._scan(os.path.join(self.directory, name)))
+
+        if self.segments:
+            self._file = open(self.segments[-1].path, "r+b")
+            # a record cut off by a crash is dropped
+            self._file.truncate(self.segments[-1].size)
+            self._file.seek(self.segments[-1].size)
+        else:
+            self._roll()
+
+        self._thread = threading.Thread(target=self._run, name="chat-log", daemon=True)
+        self._thread.start()
+        logger.info("chat_log_opened", directory=self.directory, segments=len(self.segments))
+
+    def _scan(self, path) -> Segment:
+        """
+        rebuilds the index of an existing segment.
+        :param path: str
+        :return: Segment
+        """
+        segment = Segment(path)
+        length = os.path.getsize(path)
+        if not length:
+            return segment
+
+        with open(path, "rb") as file, mmap.mmap(file.fileno(), length, access=mmap.ACCESS_READ) as view:
+            offset = 0
+            while offset + RECORD.size <= length:
+                size, _, name_size = RECORD.unpack_from(view, offset)
+                end = offset + RECORD.size + size
+                if end > length:
+                    break
+                lobby_name = view[offset + RECORD.size:offset + RECORD.size + name_size].decode()
+                segment.add(lobby_name, offset)
+                offset = end
+            segment.size = offset
+        return segment
+
+    def _roll(self) -> None:
+        """
+        closes the current segment and starts a new one.
+        :return: -
+        """
+        if self._file is not None:
+            self._file.close()
+
+        path = os.path.join(self.directory, f"{len(self.segments) + 1:08d}.log")
+        self._file = open(path, "ab")
+        with self._lock:
+            self.segments.append(Segment(path))
+
+    def append(self, lobby_name, data) -> None:
+        """
+        queues a message for the next group commit.
+        :param lobby_name: str
+        :param data: message (decrypted)
+        :return: -
+        """
+        with self._condition:
+            self.pending.append((time.time(), lobby_name, data))
+            if len(self.pending) == 1:
+                self._condition.notify()
+
+    def _run(self) -> None:
+        """
+        writer thread: commits the queued messages until the log is closed.
+        :return: -
+        """
+        while True:
+            with self._condition:
+                while not self.pending and not self.closing:
+                    self._condition.wait()
+                closing = self.closing
+
+            # collects more messages before committing
+            if self.commit_window and not closing:
+                time.sleep(self.commit_window)
+
+            with self._condition:
+                batch, self.pending = self.pending, []
+
+            if batch:
+                self._commit(batch)
+            elif closing:
+                break
+
+    def _commit(self, batch) -> None:
+        """
+        writes a batch with a single write and a single fsync.
+        :param batch: list of tuples (timestamp, lobby name, message)
+        :return: -
+        """
+        segment = self.segments[-1]
+        if segment.size >= self.segment_bytes:
+            self._roll()
+            segment = self.segments[-1]
+
+        records = []
+        offsets = []
+        offset = segment.size
+        for timestamp, lobby_name, data in batch:
+            name = lobby_name.encode()
+            message = data.encode()
+            records += (RECORD.pack(len(name) + len(message), timestamp, len(name)), name, message)
+            offsets.append((lobby_name, offset))
+            offset += RECORD.size + len(name) + len(message)
+
+        try:
+            self._file.write(b"".join(records))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except OSError as error:
+            logger.error("chat_log_write_failed", messages=len(batch), error=error)
+            return
+
+        # the records become visible to readers once they are written
+        with self._lock:
+            for lobby_name, record_offset in offsets:
+                segment.add(lobby_name, record_offset)
+            segment.size = offset
+
+    def read(self, lobby_name, count, max_bytes=MAX_HISTORY_BYTES) -> list:
+        """
+        reads the most recent messages of a lobby from the mmap-ed segments.
+        Can be called from a thread (run_in_executor), it only holds the lock while it looks up the index.
+        :param lobby_name: str
+        :param count: number of messages (at most MAX_HISTORY)
+        :param max_bytes: most message bytes (utf-8) returned, older messages are left out
+        :return: list of messages, oldest first
+        """
+        count = min(count, self.MAX_HISTORY)
+        messages = collections.deque()
+        size = 0
+
+        # collects the part of every segment that has to be scanned, newest segment first
+        with self._lock:
+            scans = []
+            for segment in reversed(self.segments):
+                if count <= 0:
+                    break
+                total = segment.counts.get(lobby_name, 0)
+                if not total:
+                    continue
+                first = max(total - count, 0)
+                start = first - first % self.INDEX_STRIDE
+                scans.append((segment.path, segment.size, segment.index[lobby_name][start // self.INDEX_STRIDE],
+                              first - start, total - first))
+                count -= total - first
+
+        for path, size_limit, offset, skip, wanted in reversed(scans):
+            for message in self._scan_messages(path, size_limit, offset, lobby_name, skip, wanted):
+                messages.append(message)
+                size += len(message)
+                # newer messages push out older ones once the byte limit is reached
+                while size > max_bytes:
+                    size -= len(messages.popleft())
+        return [message.decode() for message in messages]
+
+    @staticmethod
+    def _scan_messages(path, size, offset, lobby_name, skip, wanted):
+        """
+        :param path: segment file
+        :param size: committed size of the segment
+        :param offset: offset of the first record to look at
+        :param lobby_name: str
+        :param skip: number of records of the lobby to skip before collecting
+        :param wanted: number of messages to collect, the scan stops after the last one
+        :return: generator of messages of the lobby (bytes), oldest first
+        """
+        name = lobby_name.encode()
+
+        with open(path, "rb") as file, mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ) as view:
+            while wanted and offset < size:
+                length, _, name_size = RECORD.unpack_from(view, offset)
+                start = offset + RECORD.size
+                offset = start + length
+                if not name_size == len(name) or not view[start:start + name_size] == name:
+                    continue
+                if skip:
+                    skip -= 1
+                    continue
+                wanted -= 1
+                yield view[start + name_size:offset]
+
+    def close(self) -> None:
+        """
+        commits everything still queued and stops the writer thread.
+        :return: -
+        """
+        with self._condition:
+            self.closing = True
+            self._condition.notify()
+
+        if self._thread is not None:
+            self._thread.join()
+        if self._file is not None:
+            self._file.close()
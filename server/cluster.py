@@ -0,0 +1,295 @@
+import bus
+import framing
+import log
+import outbound
+import ports
+
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import socket
+
+
+"""
+CLUSTER MODE
+Several server nodes (server.py --cluster-port P --cluster-secret S --peers host:port,...) form a full mesh over TCP.
+With --cluster-port 0 a node listens on any free port, it only has to be reachable by the other nodes.
+Nodes speak the bus protocol (see bus.py) with each other, the 'worker' field carries the node id.
+A node id is the client endpoint of the node ('host:port'), so it can be used for redirects.
+
+hello : {"op": "hello", "worker": node id, "cluster": [host, port], "peers": [[host, port], ...], "nonce": hex}
+        first message on every peer connection, the peer list is used to discover the rest of the cluster.
+auth  : {"op": "auth", "mac": hex}
+        HMAC-SHA256 of the peer's nonce with the shared cluster secret (--cluster-secret), sent after the hello.
+        A peer without a valid auth or with a message that isn't valid JSON is dropped.
+
+routing of !join for a lobby without members on this node:
+redirect : the client gets a code-2 response with the endpoint of the node that has the most members.
+forward  : the client joins on this node, chat lines of the lobby are forwarded between the nodes.
+"""
+
+logger = log.get_logger("cluster")
+
+REDIRECT = "redirect"
+FORWARD = "forward"
+
+ROUTING = (REDIRECT, FORWARD)
+
+AUTH = "auth"
+NONCE_BYTES = 16
+
+
+def parse_address(address) -> tuple:
+    """
+    :param address: 'host:port'
+    :return: tuple (host, port)
+    """
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+class ClusterNode(bus.BusEndpoint):
+    """
+    Membership of this server in the cluster: replicates the lobby directory and forwards lobby events to peers.
+    """
+    # Constant Variables
+    RETRY_DELAY = 1         # first delay between connection attempts to a peer (seconds)
+    MAX_RETRY_DELAY = 30
+
+    def __init__(self, host, port, cluster_port, seeds, handler, secret, routing=REDIRECT):
+        super().__init__(f"{host}:{port}", handler)
+        self.host = host
+        self.cluster_address = (host, cluster_port)
+        self.seeds = seeds          # list of (host, cluster port)
+        self.secret = secret.encode()   # shared by all nodes, authenticates peer connections
+        self.routing = routing
+
+        # Dynamic Variables
+        self.peers = {}             # node id -> tuple (outbound.ClientWriter, initiator node id)
+        self.address_nodes = {}     # cluster address -> node id
+        self.maintained = set()     # cluster addresses with a running connection loop
+
+    async def start(self) -> None:
+        """
+        starts listening for peers and connects to the seed nodes.
+        :return: -
+        """
+        loop = asyncio.get_event_loop()
+
+        # cluster port 0 lets the kernel pick a free port, peers learn it from the hello message
+        server = ports.open_listener(*self.cluster_address, reuse_address=True)
+        self.cluster_address = (self.host, server.getsockname()[1])
+
+        logger.info("cluster_listening", node=self.worker_id, port=self.cluster_address[1])
+        loop.create_task(self._accept_peers(loop, server))
+
+        for address in self.seeds:
+            self.maintain(address)
+
+    def maintain(self, address) -> None:
+        """
+        keeps a connection to the peer at that cluster address.
+        :param address: tuple (host, cluster port)
+        :return: -
+        """
+        address = tuple(address)
+        if address == self.cluster_address or address in self.maintained:
+            return
+        self.maintained.add(address)
+        asyncio.get_event_loop().create_task(self._maintain_peer(address))
+
+    async def _accept_peers(self, loop, server) -> None:
+        """
+        accepts incoming peer connections.
+        :param loop: current event loop
+        :param server: listening socket
+        :return: -
+        """
+        while True:
+            peer_sock, _ = await loop.sock_accept(server)
+            loop.create_task(self._handle_peer(loop, peer_sock, initiated=False))
+
+    async def _maintain_peer(self, address) -> None:
+        """
+        connects to a peer and reconnects with a growing delay whenever the connection is lost.
+        :param address: tuple (host, cluster port)
+        :return: -
+        """
+        loop = asyncio.get_event_loop()
+        delay = self.RETRY_DELAY
+
+        while True:
+            if self.address_nodes.get(address) in self.peers:
+                # already connected (the peer connected to us)
+                await asyncio.sleep(self.RETRY_DELAY)
+                continue
+
+            peer_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            peer_sock.setblocking(False)
+            try:
+                await loop.sock_connect(peer_sock, address)
+            except OSError:
+                peer_sock.close()
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.MAX_RETRY_DELAY)
+                continue
+
+            delay = self.RETRY_DELAY
+            await self._handle_peer(loop, peer_sock, initiated=True)
+            await asyncio.sleep(self.RETRY_DELAY)
+
+    async def _handle_peer(self, loop, peer_sock, initiated) -> None:
+        """
+        exchanges hello messages with a peer and receives its lobby events.
+        :param loop: current event loop
+        :param peer_sock: socket
+        :param initiated: True if this node opened the connection
+        :return: -
+        """
+        reader = framing.FrameReader(loop, peer_sock)
+        writer = outbound.ClientWriter(loop, peer_sock, flush_window=0)
+        writer.start()
+
+        try:
+            hello = await self._handshake(reader, writer)
+            if hello is not None and self._register(hello["worker"], writer, initiated):
+                node_id = hello["worker"]
+                self.address_nodes[tuple(hello["cluster"])] = node_id
+                logger.info("peer_connected", node=node_id)
+                try:
+                    # discovers the rest of the cluster
+                    for address in hello["peers"]:
+                        self.maintain(address)
+
+                    # announces the lobbies of this node
+                    for message in self.state.snapshot():
+                        if message["worker"] == self.worker_id:
+                            writer.send(bus.encode_message(message))
+                        elif message["op"] == bus.PASSWORD and self.worker_id in self.state.workers_of(message["lobby"]):
+                            writer.send(bus.encode_message(dict(message, worker=self.worker_id)))
+
+                    while (frame := await reader.read_frame()) is not None:
+                        self.receive(json.loads(frame))
+                finally:
+                    self._unregister(node_id, writer)
+        except (ValueError, KeyError, TypeError) as error:
+            # json.JSONDecodeError is a ValueError, a message without the expected fields raises the others
+            logger.warning("peer_dropped", reason="invalid message", error=error)
+
+        await writer.close()
+        peer_sock.close()
+
+    async def _handshake(self, reader, writer) -> dict | None:
+        """
+        exchanges hello and auth messages.
+        :param reader: framing.FrameReader of the peer connection
+        :param writer: outbound.ClientWriter of the peer connection
+        :return: hello of the peer or None if the peer closed the connection or failed to authenticate
+        :raises ValueError, KeyError, TypeError: on a malformed message
+        """
+        nonce = os.urandom(NONCE_BYTES).hex()
+        writer.send(bus.encode_message({
+            "op": bus.HELLO,
+            "worker": self.worker_id,
+            "cluster": self.cluster_address,
+            "peers": list(self.address_nodes),
+            "nonce": nonce,
+        }))
+
+        hello = await reader.read_frame()
+        if hello is None:
+            return None
+        hello = json.loads(hello)
+        if not hello["op"] == bus.HELLO:
+            raise ValueError(f"expected hello, got '{hello['op']}'")
+        writer.send(bus.encode_message({"op": AUTH, "mac": self._mac(hello["nonce"])}))
+
+        auth = await reader.read_frame()
+        if auth is None:
+            return None
+        auth = json.loads(auth)
+        if not auth["op"] == AUTH or not hmac.compare_digest(str(auth["mac"]), self._mac(nonce)):
+            logger.warning("peer_dropped", reason="authentication failed", node=hello["worker"])
+            return None
+        return hello
+
+    def _mac(self, nonce) -> str:
+        """
+        :param nonce: str (hex)
+        :return: HMAC of the nonce with the cluster secret (hex)
+        """
+        return hmac.new(self.secret, str(nonce).encode(), hashlib.sha256).hexdigest()
+
+    def _register(self, node_id, writer, initiated) -> bool:
+        """
+        registers a peer connection. Of two connections between the same nodes,
+        the one opened by the node with the smaller id is kept.
+        :param node_id: str
+        :param writer: outbound.ClientWriter
+        :param initiated: True if this node opened the connection
+        :return: False if the connection is a duplicate and must be closed
+        """
+        initiator = self.worker_id if initiated else node_id
+        existing = self.peers.get(node_id)
+
+        if existing is not None:
+            # a reconnect replaces the old connection, otherwise the preferred initiator wins
+            if not existing[1] == initiator and not initiator == min(self.worker_id, node_id):
+                return False
+            existing[0].closed = True
+
+        self.peers[node_id] = (writer, initiator)
+        return True
+
+    def _unregister(self, node_id, writer) -> None:
+        """
+        removes a lost peer, its members are gone as well.
+        :param node_id: str
+        :param writer: outbound.ClientWriter of the lost connection
+        :return: -
+        """
+        if not self.peers.get(node_id, (None,))[0] is writer:
+            return
+        del self.peers[node_id]
+        logger.warning("peer_lost", node=node_id)
+
+        for lobby_name in [name for name, state in self.state.lobbies.items() if node_id in state.members]:
+            self.receive({"op": bus.MEMBERS, "lobby": lobby_name, "worker": node_id, "count": 0})
+
+    def publish(self, op, lobby_name, **fields) -> None:
+        """
+        sends a lobby event to the peers that need it.
+        :param op: MEMBERS, PASSWORD, MESSAGE or KICKALL
+        :param lobby_name: str
+        :return: -
+        """
+        message = {"op": op, "lobby": lobby_name, "worker": self.worker_id, **fields}
+        if op in bus.DIRECTORY_OPS:
+            self.state.apply(message)
+            receivers = list(self.peers)
+        else:
+            receivers = self.state.workers_of(lobby_name)
+
+        frame = bus.encode_message(message)
+        for node_id in receivers:
+            peer = self.peers.get(node_id)
+            if peer is not None:
+                peer[0].send(frame)
+
+    def route(self, lobby_name) -> tuple | None:
+        """
+        finds the node a client should be redirected to for that lobby.
+        :param lobby_name: str
+        :return: tuple (host, port) of the node with the most members or None to stay on this node
+        """
+        if not self.routing == REDIRECT:
+            return None
+
+        state = self.state.lobbies.get(lobby_name)
+        if state is None or self.worker_id in state.members:
+            return None
+
+        node_id = max(sorted(state.members), key=lambda node: state.members[node])
+        return parse_address(node_id)
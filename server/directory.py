@@ -0,0 +1,127 @@
+import bisect
+import time
+
+
+"""
+LOBBY DIRECTORY
+Every lobby known to this process: the lobbies with local members and, in worker or cluster mode,
+the lobbies other processes announced on the bus (bus.MEMBERS).
+
+by_name : lobby name -> LobbyEntry      (O(1) lookup for !join / !create)
+names   : sorted list of all names      (prefix search and pages with bisect)
+
+A lobby stays in the directory as long as any process reports members (or it was just created
+and its creator is about to join). Remote lobbies carry the time this process first heard of them.
+"""
+
+
+class LobbyEntry:
+    """
+    Directory entry of one lobby.
+    """
+    __slots__ = ("name", "created", "members")
+
+    def __init__(self, name, created=None):
+        self.name = name
+        self.created = time.time() if created is None else created
+        self.members = {}       # node (worker id / node id, None in single server mode) -> member count
+
+    @property
+    def member_count(self) -> int:
+        """
+        :return: members on all processes
+        """
+        return sum(self.members.values())
+
+
+class LobbyDirectory:
+    """
+    Indexes all known lobbies by name and in name order.
+    """
+    # Constant Variables
+    PAGE_SIZE = 20
+
+    def __init__(self, local_node=None):
+        self.local_node = local_node            # node id of this process (bus.BusEndpoint.worker_id)
+
+        self.by_name = {}
+        self.names = []
+
+    def __len__(self) -> int:
+        return len(self.by_name)
+
+    def __contains__(self, lobby_name) -> bool:
+        return lobby_name in self.by_name
+
+    def get(self, lobby_name) -> LobbyEntry | None:
+        """
+        :param lobby_name: str
+        :return: LobbyEntry or None
+        """
+        return self.by_name.get(lobby_name)
+
+    def add(self, lobby_name) -> LobbyEntry:
+        """
+        registers a lobby (without members), an existing entry is kept.
+        :param lobby_name: str
+        :return: LobbyEntry
+        """
+        entry = self.by_name.get(lobby_name)
+        if entry is None:
+            entry = self.by_name[lobby_name] = LobbyEntry(lobby_name)
+            bisect.insort(self.names, lobby_name)
+        return entry
+
+    def discard(self, lobby_name) -> None:
+        """
+        removes a lobby that has no members left.
+        :param lobby_name: str
+        :return: -
+        """
+        entry = self.by_name.get(lobby_name)
+        if entry is None or entry.members:
+            return
+        del self.by_name[lobby_name]
+        del self.names[bisect.bisect_left(self.names, lobby_name)]
+
+    def update(self, lobby_name, node, count) -> None:
+        """
+        sets the member count a process reported for a lobby, a lobby without members is removed.
+        :param lobby_name: str
+        :param node: node id of the process
+        :param count: members on that process
+        :return: -
+        """
+        if count:
+            self.add(lobby_name).members[node] = count
+            return
+
+        entry = self.by_name.get(lobby_name)
+        if entry is None or node not in entry.members:
+            return
+        del entry.members[node]
+        self.discard(lobby_name)
+
+    def update_local(self, lobby_name, count) -> None:
+        """
+        :param lobby_name: str
+        :param count: members connected to this process
+        :return: -
+        """
+        self.update(lobby_name, self.local_node, count)
+
+    def search(self, prefix="", page=1, page_size=PAGE_SIZE) -> tuple:
+        """
+        lists the lobbies whose name starts with prefix, in name order.
+        :param prefix: str
+        :param page: page number (1 = first)
+        :param page_size: entries per page
+        :return: tuple (list of LobbyEntry, number of matches)
+        """
+        start = bisect.bisect_left(self.names, prefix)
+        # every name with the prefix sorts before prefix + the highest code point
+        end = bisect.bisect_left(self.names, prefix + "\U0010ffff", start) if prefix else len(self.names)
+
+        first = start + (page - 1) * page_size
+        names = self.names[first:min(first + page_size, end)] if page > 0 else []
+        return [self.by_name[name] for name in names], end - start
@@ -0,0 +1,290 @@
+import framing
+import log
+
+import asyncio
+import base64
+import json
+import os
+import socket
+
+
+"""
+GRACEFUL UPGRADE (--handoff PATH)
+A running server listens on the Unix socket PATH. A new server started with --handoff PATH --takeover
+connects to it and takes over the listening socket and every client connection, clients stay connected.
+
+new -> old : {"op": "takeover"}
+old -> new : state (JSON frame: sessions, lobbies, ...), then the sockets with SCM_RIGHTS,
+             FDS_PER_MESSAGE per message (one marker byte each), the listening socket first
+new -> old : {"op": "ready"}        the new process received everything, nothing is served yet
+old -> new : {"op": "commit"}       the old process commits its chat log and exits
+new        : restores the state once the old process is gone (the chat log is only open in one process),
+             starts serving and listens on PATH for the next upgrade.
+
+The old process never returns to its event loop between the snapshot and its exit, so no byte of a client
+is read or written twice: unread frames, partially received frames and unsent responses are part of the state.
+Closing its sockets doesn't end the connections, the new process holds duplicates of them.
+If the new process fails before 'ready', the old process just continues serving.
+
+Only a single server process (no --workers, no cluster mode) can hand off its connections.
+"""
+
+logger = log.get_logger("handoff")
+
+TAKEOVER = "takeover"
+READY = "ready"
+COMMIT = "commit"
+
+FDS_PER_MESSAGE = 200       # sockets per sendmsg (the kernel allows 253)
+TIMEOUT = 10                # seconds a step of the handoff may take
+
+
+def encode_bytes(data) -> str:
+    """
+    :param data: bytes
+    :return: str (base64) for the JSON state
+    """
+    return base64.b64encode(data).decode()
+
+
+def decode_bytes(text) -> bytes:
+    """
+    :param text: str (base64)
+    :return: bytes
+    """
+    return base64.b64decode(text)
+
+
+def dump_session(client_session) -> dict:
+    """
+    :param client_session: session.Session
+    :return: state of the session (its socket is handed over separately)
+    """
+    unsent, queued = client_session.writer.pending_output()
+    return {
+        "addr": list(client_session.addr),
+        "username": client_session.username,
+        "role": client_session.role,
+        "lobby": client_session.lobby_name(),
+        "codec": client_session.codec,
+        "compress": client_session.writer.compression_threshold(),
+        "compressed": client_session.writer.stream_started(),
+        "frames": [encode_bytes(frame) for frame in client_session.reader.frames],
+        "pending": encode_bytes(client_session.reader.decoder.buffered()),
+        "unsent": encode_bytes(unsent),
+        "queued": [encode_bytes(frame) for frame in queued]
+    }
+
+
+def load_session(client_session, state) -> None:
+    """
+    restores reader and writer of a session created for a handed over socket.
+    :param client_session: session.Session
+    :param state: dict (dump_session)
+    :return: -
+    """
+    client_session.role = state["role"]
+    client_session.codec = state["codec"]
+
+    reader = client_session.reader
+    reader.frames.extend(decode_bytes(frame) for frame in state["frames"])
+    reader.decoder.feed(decode_bytes(state["pending"]))
+
+    writer = client_session.writer
+    if state["compress"] is not None:
+        # a peer that never got a compressed batch still expects the zlib header
+        writer.enable_compression(state["compress"], continued=state["compressed"])
+    writer.restore(decode_bytes(state["unsent"]), [decode_bytes(frame) for frame in state["queued"]])
+
+
+def dump_lobby(lobby_object, created) -> dict:
+    """
+    :param lobby_object: lobby.Lobby
+    :param created: creation time (time.time()) from the lobby directory
+    :return: state of the lobby
+    """
+    return {
+        "name": lobby_object.name,
+        "instance": lobby_object.instance,
+        "creator": list(lobby_object.creator),
+        "created": created,
+        "password": lobby_object.password,
+        "history": [data for data, _ in lobby_object.history.entries],
+        "policy": [lobby_object.policy.mode, lobby_object.policy.disconnect_after],
+        "flood": [[limit.rate, limit.burst] for limit in lobby_object.flood.limits]
+    }
+
+
+def load_lobby(lobby_object, state) -> None:
+    """
+    restores a lobby object created for a handed over lobby.
+    :param lobby_object: lobby.Lobby
+    :param state: dict (dump_lobby)
+    :return: -
+    """
+    lobby_object.password = state["password"]
+    lobby_object.history.clear()
+    for data in state["history"]:
+        lobby_object.history.append(data, {})
+    lobby_object.policy.mode, lobby_object.policy.disconnect_after = state["policy"]
+    for kind, (rate, burst) in enumerate(state["flood"]):
+        lobby_object.flood.set_limit(kind, rate, burst)
+
+
+def send_message(conn, message) -> None:
+    """
+    :param conn: blocking Unix socket
+    :param message: dict
+    :return: -
+    """
+    conn.sendall(framing.encode_frame(json.dumps(message).encode()))
+
+
+def receive_message(conn) -> dict:
+    """
+    reads exactly one frame, so no marker byte of a following socket message is consumed.
+    :param conn: blocking Unix socket
+    :return: dict
+    """
+    (length,) = framing.HEADER.unpack(receive_exactly(conn, framing.HEADER_SIZE))
+    return json.loads(receive_exactly(conn, length))
+
+
+async def read_message(loop, conn) -> dict:
+    """
+    reads exactly one frame through the event loop, the other clients are served meanwhile.
+    :param loop: running event loop
+    :param conn: non-blocking Unix socket
+    :return: dict
+    """
+    (length,) = framing.HEADER.unpack(await read_exactly(loop, conn, framing.HEADER_SIZE))
+    return json.loads(await read_exactly(loop, conn, length))
+
+
+async def read_exactly(loop, conn, size) -> bytes:
+    """
+    :param loop: running event loop
+    :param conn: non-blocking socket
+    :param size: int
+    :return: bytes
+    """
+    data = bytearray()
+    while len(data) < size:
+        chunk = await loop.sock_recv(conn, size - len(data))
+        if not chunk:
+            raise ConnectionError("[handoff] connection closed during the handoff.")
+        data += chunk
+    return bytes(data)
+
+
+def receive_exactly(conn, size) -> bytes:
+    """
+    :param conn: blocking socket
+    :param size: int
+    :return: bytes
+    """
+    data = bytearray()
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("[handoff] connection closed during the handoff.")
+        data += chunk
+    return bytes(data)
+
+
+def listen(path) -> socket.socket:
+    """
+    :param path: path of the handoff socket (a stale socket file is replaced)
+    :return: non-blocking listening Unix socket
+    """
+    if os.path.exists(path):
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(1)
+    sock.setblocking(False)
+    return sock
+
+
+async def serve(loop, path, listener, snapshot, finish) -> None:
+    """
+    waits for a new server process and hands everything over to it.
+    :param loop: running event loop
+    :param path: path of the handoff socket
+    :param listener: listening socket of the server
+    :param snapshot: callable() -> tuple (state dict, list of client sockets), must not await anything
+    :param finish: callable() that commits what is left and ends this process
+    :return: -
+    """
+    handoff_sock = listen(path)
+    logger.info("handoff_listening", path=path)
+
+    while True:
+        conn, _ = await loop.sock_accept(handoff_sock)
+        try:
+            # the request is read without blocking, a connection that sends nothing doesn't stall the clients
+            if (await asyncio.wait_for(read_message(loop, conn), TIMEOUT))["op"] != TAKEOVER:
+                continue
+
+            # from here on the event loop doesn't run again, the state can't change anymore
+            state, clients = snapshot()
+            conn.setblocking(True)
+            conn.settimeout(TIMEOUT)
+            sockets = [listener, *clients]
+            state["sockets"] = len(sockets)
+            send_message(conn, state)
+            for first in range(0, len(sockets), FDS_PER_MESSAGE):
+                socket.send_fds(conn, [b"S"], [sock.fileno() for sock in sockets[first:first + FDS_PER_MESSAGE]])
+
+            if receive_message(conn)["op"] == READY:
+                logger.info("handed_off", connections=len(clients))
+                send_message(conn, {"op": COMMIT})
+                finish()
+        except (OSError, ValueError, asyncio.TimeoutError) as error:
+            # the new process failed, this one continues serving
+            logger.error("handoff_failed", error=error)
+        finally:
+            conn.close()
+
+
+def request(path) -> tuple:
+    """
+    takes over the sockets and the state of the server listening for handoffs on path.
+    :param path: path of the handoff socket
+    :return: tuple (handoff connection, listening socket, list of client sockets, state dict)
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(TIMEOUT)
+    conn.connect(path)
+    send_message(conn, {"op": TAKEOVER})
+
+    state = receive_message(conn)
+    sockets = []
+    while len(sockets) < state["sockets"]:
+        _, fds, flags, _ = socket.recv_fds(conn, 1, FDS_PER_MESSAGE)
+        if not fds or flags & socket.MSG_CTRUNC:
+            for fd in fds:
+                os.close(fd)
+            raise ConnectionError("[handoff] didn't receive the sockets.")
+        for fd in fds:
+            sock = socket.socket(fileno=fd)
+            sock.setblocking(False)
+            sockets.append(sock)
+
+    logger.info("took_over", connections=len(sockets) - 1)
+    return conn, sockets[0], sockets[1:], state
+
+
+def confirm(conn) -> None:
+    """
+    tells the old process that the state is restored and waits until it exited.
+    :param conn: handoff connection (request)
+    :return: -
+    """
+    send_message(conn, {"op": READY})
+    if receive_message(conn)["op"] != COMMIT:
+        raise ConnectionError("[handoff] the old process didn't commit the handoff.")
+    # the old process closes the connection when it exits
+    while conn.recv(1):
+        pass
+    conn.close()
@@ -0,0 +1,153 @@
+import log
+import metrics
+
+import asyncio
+import math
+import socket
+import time
+
+
+"""
+HEARTBEATS
+Every connection has one entry in a hashed timer wheel. Receiving data never touches the wheel,
+the FrameReader only notes the time. When an entry expires, the connection is checked:
+- quiet for less than the ping interval : the entry is scheduled again for the end of the interval.
+- quiet for longer                      : the client gets a ping (code 6) and has pong_timeout seconds to answer.
+- quiet after the pong timeout          : the connection is shut down (reaped).
+Clients answer a ping with '!pong', any other frame counts as well.
+"""
+
+logger = log.get_logger("heartbeat")
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel: slot_count slots of tick seconds, timers further away than one revolution
+    count the revolutions they still have to wait. Scheduling and cancelling are O(1),
+    advancing processes one slot.
+    """
+    # Constant Variables
+    SLOT_COUNT = 512
+
+    def __init__(self, tick, slot_count=SLOT_COUNT):
+        self.tick = tick
+        self.slots = [{} for _ in range(slot_count)]    # key -> remaining revolutions
+        self.position = 0
+        self.entries = {}                               # key -> slot index
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def schedule(self, key, delay) -> None:
+        """
+        (re)schedules the timer of a key.
+        :param key: hashable
+        :param delay: seconds
+        :return: -
+        """
+        self.cancel(key)
+        ticks = max(1, math.ceil(delay / self.tick))
+        index = (self.position + ticks) % len(self.slots)
+        self.slots[index][key] = (ticks - 1) // len(self.slots)
+        self.entries[key] = index
+
+    def cancel(self, key) -> None:
+        """
+        :param key: hashable
+        :return: -
+        """
+        index = self.entries.pop(key, None)
+        if index is not None:
+            del self.slots[index][key]
+
+    def advance(self) -> list:
+        """
+        moves the wheel by one tick.
+        :return: list of keys whose timer expired
+        """
+        self.position = (self.position + 1) % len(self.slots)
+        slot = self.slots[self.position]
+
+        expired = []
+        for key, revolutions in slot.items():
+            if revolutions:
+                slot[key] = revolutions - 1
+            else:
+                expired.append(key)
+
+        for key in expired:
+            del slot[key]
+            del self.entries[key]
+        return expired
+
+
+class HeartbeatMonitor:
+    """
+    Pings quiet connections and reaps the ones that stopped answering, driven by a single TimerWheel.
+    """
+    # Constant Variables
+    PING_INTERVAL = 30      # seconds without data until a client is pinged
+    PONG_TIMEOUT = 10       # seconds a pinged client has to answer
+    TICK = 1
+
+    def __init__(self, sessions, ping_response, ping_interval=PING_INTERVAL, pong_timeout=PONG_TIMEOUT, tick=TICK):
+        self.sessions = sessions            # session.SessionRegistry
+        self.ping_response = ping_response  # server_response.StaticResponse (code 6)
+        self.ping_interval = ping_interval
+        self.pong_timeout = pong_timeout
+        self.wheel = TimerWheel(tick)
+
+    def add(self, client_session) -> None:
+        """
+        :param client_session: session.Session
+        :return: -
+        """
+        self.wheel.schedule(client_session.fd, self.ping_interval)
+
+    def remove(self, client_session) -> None:
+        """
+        :param client_session: session.Session
+        :return: -
+        """
+        self.wheel.cancel(client_session.fd)
+
+    def check(self) -> None:
+        """
+        advances the wheel and handles every expired connection.
+        :return: -
+        """
+        now = time.monotonic()
+        reaped = 0
+
+        for fd in self.wheel.advance():
+            client_session = self.sessions.get(fd)
+            if client_session is None:
+                continue
+
+            quiet = now - client_session.reader.last_received
+            if quiet >= self.ping_interval + self.pong_timeout:
+                # shutting down the socket wakes up the pending receive of the connection handler.
+                try:
+                    client_session.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                reaped += 1
+            elif quiet >= self.ping_interval:
+                client_session.writer.send(self.ping_response.frame(client_session.codec))
+                metrics.counters["heartbeat_pings"] += 1
+                self.wheel.schedule(fd, self.ping_interval + self.pong_timeout - quiet)
+            else:
+                self.wheel.schedule(fd, self.ping_interval - quiet)
+
+        if reaped:
+            metrics.counters["reaped_connections"] += reaped
+            logger.info("reaped", connections=reaped)
+
+    async def run(self) -> None:
+        """
+        checks the wheel every tick.
+        :return: -
+        """
+        while True:
+            await asyncio.sleep(self.wheel.tick)
+            self.check()
@@ -0,0 +1,78 @@
+import wire
+
+import collections
+
+
+class MessageHistory:
+    """
+    Ring buffer of the most recent chat messages of a lobby, limited by message count and by bytes.
+    Every entry keeps its frames per wire format, so a message is serialized at most once per codec
+    no matter how many members get it replayed.
+    """
+    # Constant Variables
+    MAX_MESSAGES = 50
+    MAX_BYTES = 64 * 1024
+
+    def __init__(self, template, max_messages=MAX_MESSAGES, max_bytes=MAX_BYTES):
+        self.template = template            # server_response.ResponseTemplate used to render missing codecs
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+
+        # Dynamic Variables
+        self.entries = collections.deque()  # contains tuples (message, dict codec -> frame)
+        self.size = 0                       # bytes of all stored frames
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def append(self, data, frames) -> None:
+        """
+        stores a message and evicts the oldest ones until both limits are met again.
+        :param data: message (decrypted)
+        :param frames: dict codec -> frame of the codecs that were already serialized (kept, not copied)
+        :return: -
+        """
+        if not frames:
+            # nobody received the message here, one frame keeps the byte limit meaningful
+            frames[wire.JSON] = self.template.render(data, wire.JSON)
+
+        self.entries.append((data, frames))
+        self.size += sum(len(frame) for frame in frames.values())
+        self._evict()
+
+    def _evict(self) -> None:
+        """
+        discards the oldest messages while a limit is exceeded.
+        :return: -
+        """
+        while self.entries and (len(self.entries) > self.max_messages or self.size > self.max_bytes):
+            _, frames = self.entries.popleft()
+            self.size -= sum(len(frame) for frame in frames.values())
+
+    def replay(self, codec, count=None) -> bytes:
+        """
+        :param codec: wire.JSON or wire.BINARY
+        :param count: optional number of most recent messages, all stored messages by default
+        :return: the stored messages as consecutive frames of that codec (b"" if empty)
+        """
+        entries = self.entries
+        if count is not None and count < len(entries):
+            entries = list(entries)[len(entries) - count:] if count else []
+
+        replay = []
+        for data, frames in entries:
+            frame = frames.get(codec)
+            if frame is None:
+                frame = frames[codec] = self.template.render(data, codec)
+                self.size += len(frame)
+            replay.append(frame)
+
+        self._evict()
+        return b"".join(replay)
+
+    def clear(self) -> None:
+        """
+        :return: -
+        """
+        self.entries.clear()
+        self.size = 0
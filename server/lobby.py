@@ -1,100 +1,206 @@
 import server_response
-import ports
+import log
+import outbound
+import history
+import session
+import bus
+import metrics
+import profiling
+import ratelimit
 
 import asyncio
 import socket
-import json
+import time
+
+
+logger = log.get_logger("lobby")
 
 
 class Lobby:
+    """
+    A chat room hosted inside the main server process.
+    Sessions are moved into the lobby by the main server (!join / !create), no extra socket or thread is needed.
+    """
     # Constant Variables
     HOST = socket.gethostbyname(socket.gethostname())
-    PORT = ports.get_open_port(HOST)
-    BUFFER = 1024
-
-    # Dynamic Variables
-    connected_clients = []      # contains tuples (client_sock, addr)
-    running = True              # changes when the server stops running
-    password = ""
 
-    user_counter = 0
+    # Pre-encoded responses
+    MESSAGE = server_response.ResponseTemplate(1, HOST)
+    PASSWORD_QUERY = server_response.StaticResponse(1, HOST, msg="Enter Lobby password:")
+    INVALID_PASSWORD = server_response.StaticResponse(1, HOST, msg="Invalid password. Closing connection.")
+    THROTTLED = server_response.StaticResponse(3, HOST, msg="You are sending too fast, slow down.")
+
+    def __init__(self, name, creator, sessions, bus_client=None, chat_log=None, directory=None, instance=None):
+        self.name = name                # Name of the new lobby
+        self.creator = creator          # creator is a tuple containing the ip and port of the client
+        self.sessions = sessions        # session.SessionRegistry of the server
+        self.bus_client = bus_client    # bus.BusClient in worker mode, members on other workers share the lobby
+        self.chat_log = chat_log        # chatlog.ChatLog if transcripts are persisted
+        self.directory = directory      # directory.LobbyDirectory of the server, keeps the member count
+        # transcript key in the chat log, a later lobby with the same name starts a new transcript
+        self.instance = instance or f"{name}@{time.time_ns()}"
+
+        # Dynamic Variables
+        self.password = "" if bus_client is None else bus_client.password(name)
+        self.policy = outbound.BackpressurePolicy()     # shared by the writers of all members
+        self.flood = ratelimit.FloodPolicy()            # flood control of all members
+        self.history = history.MessageHistory(self.MESSAGE)     # replayed to new members
+
+    @property
+    def connected_clients(self) -> dict:
+        """
+        :return: dict fd -> session.Session of all members, in joining order.
+        """
+        return self.sessions.members(self.name)
 
-    stop_event = asyncio.Event()
+    def is_empty(self) -> bool:
+        """
+        :return: True if no client is connected to this lobby.
+        """
+        return len(self.connected_clients) == 0
 
-    def __init__(self, name, creator):
-        self.name = name        # Name of the new lobby
-        self.creator = creator  # creator is a tuple containing the ip and port of the client
+    def remote_members(self) -> int:
+        """
+        :return: number of members connected to other worker processes.
+        """
+        return 0 if self.bus_client is None else self.bus_client.remote_members(self.name)
 
-    def create_lobby(self) -> None:
+    def publish(self, op, **fields) -> None:
         """
-        method to start the lobby.
+        forwards a lobby event to the other worker processes (worker mode only).
+        :param op: bus operation
         :return: -
         """
-        asyncio.run(self.lobby_setup())
+        if self.bus_client is not None:
+            self.bus_client.publish(op, self.name, **fields)
 
-    def close(self) -> None:
+    def announce_members(self) -> None:
         """
-        closes the server.
+        reports the number of members connected to this process to the directory and the other processes.
         :return: -
         """
-        # Sets the stop_event to stop the infinite loop.
-        self.stop_event.set()
-
-        # Resets the password
-        self.password = ""
-
-        # connects a dummy to skip the await loop.sock_accept() function.
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as dummy:
-            dummy.connect((self.HOST, self.PORT))
-            dummy.close()
+        count = len(self.connected_clients)
+        if self.directory is not None:
+            self.directory.update_local(self.name, count)
+        self.publish(bus.MEMBERS, count=count)
 
-    async def send_all(self, loop, client, addr, data) -> None:
+    def handle_bus_message(self, message) -> None:
         """
-        sends data to all clients in the connected clients list.
-        :param loop: current event loop
-        :param client: socket client object
-        :param addr: client address
+        applies a lobby event published by another worker process.
+        :param message: dict
+        :return: -
+        """
+        match message["op"]:
+            case "message":
+                self.deliver(message["msg"])
+            case "password":
+                self.password = message["password"]
+            case "kickall":
+                self.close()
+
+    def close(self, keep=None) -> None:
+        """
+        closes the lobby by disconnecting every client.
+        :param keep: optional session.Session that stays connected
+        :return: -
+        """
+        for member in list(self.connected_clients.values()):
+            if member is keep:
+                continue
+            # shutting down the socket wakes up the pending receive in handle_client.
+            try:
+                member.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+        # Resets the password and the history
+        if keep is None:
+            self.password = ""
+            self.history.clear()
+
+    def send_all(self, sender, data) -> None:
+        """
+        sends data to all clients in the connected clients list (on every worker process).
+        The message is serialized once and queued to every receiver's writer.
+        :param sender: session.Session that sent the message
         :param data: message (decrypted)
         :return: -
         """
-        for receiver_clients in self.connected_clients:
-            if not receiver_clients == (client, addr):
-                await self.send_to(loop, receiver_clients[0], receiver_clients[1], data)
+        self.deliver(data, sender)
+        self.publish(bus.MESSAGE, msg=data)
 
-    async def send_to(self, loop, client, addr, data) -> None:
+    def deliver(self, data, sender=None) -> None:
         """
-        Formats and sends data to the client according to the protocol (json-format).
+        queues a message for the members connected to this process.
+        :param data: message (decrypted)
+        :param sender: optional session.Session that doesn't receive the message
+        :return: -
+        """
+        start = time.perf_counter()
+        sender_fd = None if sender is None else sender.fd
+        frames = {}     # codec -> frame, every wire format is serialized at most once
+
+        for fd, receiver in self.connected_clients.items():
+            if not fd == sender_fd:
+                frame = frames.get(receiver.codec)
+                if frame is None:
+                    frame = frames[receiver.codec] = self.MESSAGE.render(data, receiver.codec)
+                receiver.writer.send(frame, droppable=True)
+
+        metrics.counters["chat_messages"] += 1
+        metrics.fanout_seconds.observe(time.perf_counter() - start)
+
+        # the history reuses the frames, later members only need to render other codecs
+        self.history.append(data, frames)
+        if self.chat_log is not None:
+            self.chat_log.append(self.instance, data)
+
+    def send_to(self, client_session, data) -> None:
+        """
+        Formats and queues data for the client according to the protocol (negotiated wire format).
         ! Only for messages !
-        :param loop: current event loop
-        :param client: socket client object
-        :param addr: client address
+        :param client_session: session.Session of the client
         :param data: message (decrypted)
         :return: -
         """
-        message = server_response.generate_response(1, self.HOST, msg=data)
-        serialized_msg = json.dumps(message).encode()
-        await loop.sock_sendto(client, serialized_msg, addr)
+        client_session.writer.send(self.MESSAGE.render(data, client_session.codec))
 
-    async def handle_client(self, client, addr, **kwargs):
+    async def send_history(self, client_session, count) -> None:
         """
-        manages the connected clients.
+        sends the last messages of the lobby, from the chat log if there is one, otherwise from the in-memory history.
+        The log is read in a thread (it scans segment files), the frames are chat frames under the backpressure policy.
+        :param client_session: session.Session of the client
+        :param count: number of messages
+        :return: -
+        """
+        writer = client_session.writer
+        if self.chat_log is None:
+            frames = self.history.replay(client_session.codec, count)
+            if frames:
+                writer.send(frames, droppable=True)
+            return
+
+        messages = await asyncio.get_running_loop().run_in_executor(None, self.chat_log.read, self.instance, count)
+        for data in messages:
+            if not writer.send(self.MESSAGE.render(data, client_session.codec), droppable=True):
+                break
+
+    async def handle_client(self, client_session, resumed=False) -> None:
+        """
+        manages a client that was moved into this lobby.
         - handles commands
         - normal messages are sent to all connected clients in this lobby.
-        :param client: client socket
-        :param addr: address
+        :param client_session: session.Session (its reader keeps already received frames)
+        :param resumed: True for a member taken over from the previous server process (handoff.py),
+                        it skips the password check and keeps its role
         :return: -
         """
-        async def receive_full_msg() -> str:
+        async def receive_full_msg() -> str | None:
             """
-            receives and reassembles buffered data from the client.
-            :return: string
+            receives the next complete frame from the client.
+            :return: string or None if the client disconnected
             """
-            f_data = b""
-            while True:                                                 # loop to assemble larger messages
-                f_data += await loop.sock_recv(client, self.BUFFER)
-                if len(f_data) < self.BUFFER:                           # if message is smaller than the buffer, break
-                    break
-            return f_data.decode()
+            return await reader.read_text()
 
         async def client_loop() -> None:
             """
@@ -103,18 +209,40 @@ class Lobby:
             """
             # loop to receive incoming messages
             while True:
+                started = profiling.now()
                 data = await receive_full_msg()
-                if data == "!exit":
+                profiling.record("lobby.receive", started)
+                if data is None or data == "!exit":
                     # !exit closes the connection between client and server and stops the client loop.
                     break
-
+                if data == "!pong":
+                    # heartbeat answer, the reader already noted the activity
+                    continue
+
+                # flood control before anything is dispatched
+                kind = ratelimit.COMMAND if data.startswith('!') else ratelimit.CHAT
+                action = self.flood.check(client_session.flood, kind)
+                if not action == ratelimit.ALLOW:
+                    if action == ratelimit.WARN:
+                        writer.send(self.THROTTLED.frame(client_session.codec))
+                    elif action == ratelimit.MUTE:
+                        self.send_to(client_session, f"You are muted for {self.flood.mute_seconds} seconds.")
+                    continue
+
+                started = profiling.now()
+
+                # !history [n] is available to every member
+                command = data.split(" ")
+                if command[0] == "!history" and len(command) == 2 and command[1].isdigit():
+                    await self.send_history(client_session, int(command[1]))
                 # checks if client is admin and if the received message starts with '!'
-                if (client, addr) == admin and data.startswith('!'):
+                elif client_session.role == session.ADMIN and data.startswith('!'):
                     # handles admin commands
                     await handle_superuser_commands(data)
                 else:
                     # sends message to all clients connected to this lobby
-                    await self.send_all(loop, client, addr, username + " >> " + data)
+                    self.send_all(client_session, client_session.username + " >> " + data)
+                profiling.record("lobby.dispatch", started)
 
         async def check_password() -> bool:
             """
@@ -123,21 +251,18 @@ class Lobby:
             """
             # Checks if the admin set a password for the lobby.
             if not self.password == "":
-                # generates password query
-                password_query = server_response.generate_response(1, self.HOST, msg="Enter Lobby password:")
-                serialized_query = json.dumps(password_query).encode()
-
                 # Sends password query to the client
-                await loop.sock_sendto(client, serialized_query, addr)
+                writer.send(self.PASSWORD_QUERY.frame(client_session.codec))
 
-                # Waits for client response
+                # Waits for client response (heartbeat answers are skipped)
                 password = await receive_full_msg()
+                while password == "!pong":
+                    password = await receive_full_msg()
 
                 # Checks if client response matches lobby password
                 if not password == self.password:
                     # If the client entered the wrong password, the connection closes.
-                    await self.send_to(loop, client, addr, "Invalid password. Closing connection.")
-                    client.close()
+                    writer.send(self.INVALID_PASSWORD.frame(client_session.codec))
                     return False
             return True
 
@@ -153,57 +278,68 @@ class Lobby:
                 case "!set_password":
                     if len(command) == 2:
                         self.password = command[1]
+                        self.publish(bus.PASSWORD, password=self.password)
                 case "!kickall":
-                    self.stop_event.set()
-
-        username = kwargs.get("username", "")
-
-        loop = asyncio.get_event_loop()
-        admin = self.connected_clients[0]                           # The first client is always the admin
+                    self.close(keep=client_session)
+                    self.publish(bus.KICKALL)
+                case "!profile":
+                    # !profile [seconds]
+                    seconds = int(command[1]) if len(command) == 2 and command[1].isdigit() else None
+                    if not profiling.allow_command:
+                        self.send_to(client_session, "[profiling] is disabled on this server.")
+                    elif profiling.start(seconds or profiling.DEFAULT_SECONDS):
+                        self.send_to(client_session, f"[profiling] started, results go to {profiling.PROFILE_DIR}")
+                    else:
+                        self.send_to(client_session, "[profiling] already running.")
+                case "!set_flood":
+                    # !set_flood [chat | command] [messages per second] [burst]
+                    try:
+                        self.flood.set_limit(ratelimit.KINDS[command[1]], float(command[2]), int(command[3]))
+                    except (IndexError, KeyError, ValueError):
+                        self.send_to(client_session, "Usage: !set_flood [chat | command] [rate] [burst]")
+                case "!stats":
+                    self.send_to(client_session, metrics.summary(self))
+                case "!set_policy":
+                    # !set_policy [drop_oldest | drop_newest | disconnect] [seconds]
+                    if 2 <= len(command) <= 3 and command[1] in outbound.POLICIES:
+                        self.policy.mode = command[1]
+                        if len(command) == 3 and command[2].isdigit():
+                            self.policy.disconnect_after = int(command[2])
+
+        reader = client_session.reader
+        writer = client_session.writer
 
         # Check lobby password
-        if not await check_password():
+        if not resumed and not await check_password():
             return
 
-        # Sends success message
-        await self.send_to(loop, client, addr, f"You successfully connected to {self.name}")
-
-        # Starts the client loop to receive and send data.
-        await client_loop()
-
-        # disconnect the client and remove it from the connected clients list.
-        client.close()
-        self.connected_clients.remove((client, addr))
-
-        if len(self.connected_clients) == 0:
-            self.close()
-
-    async def lobby_setup(self) -> None:
-        def lobby_loop():
-            print(f"[lobby_setup] {addr} joined '{self.name}'.")
-            self.connected_clients.append((client, addr))
-            loop.create_task(self.handle_client(client, addr, username=f"user-{self.user_counter}"))
-            self.user_counter += 1
-        print(f"[lobby_setup] creating new lobby on port {self.PORT} ...")
-
-        # TCP server socket setup
-        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server.bind((self.HOST, self.PORT))
-        server.listen(8)
-        server.setblocking(False)
-
-        print(f"[lobby_setup] new lobby ({self.name} by '{self.creator[0]}') successfully created on port {self.PORT}.")
-
-        # Get event loop
-        loop = asyncio.get_event_loop()
-
-        # handle incoming client connection
-        while not self.stop_event.is_set():
-            client, addr = await loop.sock_accept(server)
-            if self.stop_event.is_set():
-                break
-            lobby_loop()
-
-        print(f"[lobby_setup] closing lobby server ('{self.name}')...")
-        server.close()
-        ports.blocked_ports.remove(self.PORT)
+        logger.info("joined", conn=client_session.fd, addr=client_session.addr[0], lobby=self.name)
+        # The first client is always the admin
+        if not resumed and self.is_empty() and not self.remote_members():
+            client_session.role = session.ADMIN
+        self.sessions.move(client_session, self)
+        writer.policy = self.policy
+        self.announce_members()
+
+        try:
+            if not resumed:
+                # Sends success message
+                self.send_to(client_session, f"You successfully connected to {self.name}")
+
+                # replays the recent messages with a single write
+                if self.history:
+                    writer.send(self.history.replay(client_session.codec), droppable=True)
+
+            # Starts the client loop to receive and send data.
+            await client_loop()
+        finally:
+            # remove the client from the connected clients list.
+            self.sessions.move(client_session, None)
+            self.announce_members()
+            logger.info("left", conn=client_session.fd, addr=client_session.addr[0], lobby=self.name)
+
+            # hands the admin role to the oldest remaining member
+            if client_session.role == session.ADMIN:
+                client_session.role = session.USER
+                if not self.is_empty():
+                    next(iter(self.connected_clients.values())).role = session.ADMIN
@@ -0,0 +1,185 @@
+import collections
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+
+
+"""
+LOGGING
+Server events are logged as structured records: an event name plus key/value fields
+(conn = fd of the connection, lobby = lobby name, ...).
+
+kv   : 2026-01-01T12:00:00.123 level=info logger=server event=connected conn=7 addr=127.0.0.1
+json : {"ts": "2026-01-01T12:00:00.123", "level": "info", "logger": "server", "event": "connected", "conn": 7, ...}
+
+The event loop only checks the level and puts the record into a bounded queue, a background thread formats
+and writes it. A full queue drops records (counted in log_counters) instead of blocking the loop.
+Level and format come from CHAT_LOG_LEVEL (debug, info, warning, error) and CHAT_LOG_FORMAT (kv, json)
+or the --log-level / --log-format options of the server.
+"""
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+FORMATS = ("kv", "json")
+QUEUE_SIZE = 10000          # records waiting for the writer thread
+
+LOG_LEVEL = os.environ.get("CHAT_LOG_LEVEL", "info").lower()
+LOG_FORMAT = os.environ.get("CHAT_LOG_FORMAT", "kv").lower()
+
+log_counters = collections.Counter()    # dropped -> records lost to a full queue
+
+_root = logging.getLogger("chat")
+_root.propagate = False
+_listener = None            # logging.handlers.QueueListener of this process
+_pid = None                 # process that started the listener (worker processes start their own)
+
+
+class EventLogger:
+    """
+    Logger of one module. Every method returns right away if its level is disabled,
+    callers with expensive fields check enabled() first.
+    """
+    __slots__ = ("logger",)
+
+    def __init__(self, name):
+        self.logger = _root.getChild(name)
+
+    def enabled(self, level) -> bool:
+        """
+        :param level: DEBUG, INFO, WARNING or ERROR
+        :return: True if records of this level are written
+        """
+        return self.logger.isEnabledFor(level)
+
+    def log(self, level, event, fields) -> None:
+        """
+        :param level: DEBUG, INFO, WARNING or ERROR
+        :param event: str
+        :param fields: dict of key/value fields
+        :return: -
+        """
+        if self.logger.isEnabledFor(level):
+            # makeRecord skips the caller lookup of Logger.log
+            record = self.logger.makeRecord(self.logger.name, level, "", 0, event, (), None)
+            record.fields = fields
+            self.logger.handle(record)
+
+    def debug(self, event, **fields) -> None:
+        self.log(DEBUG, event, fields)
+
+    def info(self, event, **fields) -> None:
+        self.log(INFO, event, fields)
+
+    def warning(self, event, **fields) -> None:
+        self.log(WARNING, event, fields)
+
+    def error(self, event, **fields) -> None:
+        self.log(ERROR, event, fields)
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Formats records of an EventLogger as key/value pairs or as JSON.
+    """
+    def __init__(self, style="kv"):
+        super().__init__()
+        self.style = style
+
+    def format(self, record) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname.lower(),
+            "logger": record.name.removeprefix("chat."),
+            "event": record.msg
+        }
+        entry.update(getattr(record, "fields", {}))
+
+        if self.style == "json":
+            return json.dumps(entry, default=str)
+        return " ".join(f"{key}={self._value(value)}" if key != "ts" else value for key, value in entry.items())
+
+    @staticmethod
+    def _value(value) -> str:
+        """
+        quotes values that would break the key/value format.
+        :param value: any
+        :return: str
+        """
+        text = str(value)
+        if not text or any(character in text for character in ' "=\n'):
+            return json.dumps(text)
+        return text
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the writer thread unformatted and never blocks.
+    """
+    def prepare(self, record):
+        # formatting happens on the writer thread
+        return record
+
+    def enqueue(self, record) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_counters["dropped"] += 1
+
+
+def get_logger(name) -> EventLogger:
+    """
+    :param name: module name (shown as logger=<name>)
+    :return: EventLogger
+    """
+    return EventLogger(name)
+
+
+def start(level=None, style=None, stream=None) -> None:
+    """
+    starts the writer thread of this process. Later calls in the same process are ignored,
+    a forked worker process has to call it again.
+    :param level: 'debug', 'info', 'warning' or 'error' (default: LOG_LEVEL)
+    :param style: 'kv' or 'json' (default: LOG_FORMAT)
+    :param stream: output (default: sys.stderr)
+    :return: -
+    """
+    global _listener, _pid
+
+    if _pid == os.getpid():
+        return
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(StructuredFormatter(style or LOG_FORMAT))
+
+    # handlers inherited from the parent process point to a queue without a writer thread
+    for handler in list(_root.handlers):
+        _root.removeHandler(handler)
+
+    records = queue.Queue(QUEUE_SIZE)
+    _root.addHandler(_QueueHandler(records))
+    _root.setLevel(LEVELS.get(level or LOG_LEVEL, INFO))
+
+    _listener = logging.handlers.QueueListener(records, output)
+    _listener.start()
+    _pid = os.getpid()
+
+
+def stop() -> None:
+    """
+    writes the queued records and stops the writer thread.
+    :return: -
+    """
+    global _listener, _pid
+
+    if _listener is not None and _pid == os.getpid():
+        _listener.stop()
+    _listener = None
+    _pid = None
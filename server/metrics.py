@@ -0,0 +1,244 @@
+import admission
+import framing
+import log
+import outbound
+import ratelimit
+
+import asyncio
+import bisect
+import collections
+import socket
+
+
+"""
+RUNTIME METRICS
+Recording only increments counters or a histogram bucket, values that describe the current state
+(connections, lobby members, queue depths) are computed when the metrics are read.
+
+!stats (lobby admins) returns a short summary of their lobby, --metrics-port serves every metric in the
+Prometheus text format on http://127.0.0.1:<port>/metrics.
+"""
+
+logger = log.get_logger("metrics")
+
+commands = collections.Counter()        # command ('!join', ...) -> how often handle_lobby_commands handled it
+counters = collections.Counter()        # connections_accepted, chat_messages, ...
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram (cumulative buckets like Prometheus). Observing a value is a single bisect.
+    """
+    # Constant Variables
+    BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+    def __init__(self, name, description, buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+
+        # Dynamic Variables
+        self.counts = [0] * (len(buckets) + 1)     # the last bucket counts values above every bound
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value) -> None:
+        """
+        :param value: float (seconds)
+        :return: -
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, fraction) -> float | None:
+        """
+        :param fraction: float between 0 and 1
+        :return: upper bound of the bucket that contains the quantile (None without observations)
+        """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def render(self) -> list:
+        """
+        :return: lines in the Prometheus text format
+        """
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+
+fanout_seconds = Histogram("chat_fanout_seconds", "time to queue a chat message for every lobby member")
+loop_lag_seconds = Histogram("event_loop_lag_seconds", "delay of event loop callbacks behind their schedule")
+
+
+async def monitor_loop_lag(interval=0.25) -> None:
+    """
+    measures how late the event loop wakes up a sleeping task.
+    :param interval: seconds between two measurements
+    :return: -
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        loop_lag_seconds.observe(max(loop.time() - start - interval, 0.0))
+
+
+def queue_depths(client_sessions) -> tuple:
+    """
+    :param client_sessions: iterable of session.Session
+    :return: tuple (queued frames, queued bytes, largest queue in bytes) of their client writers
+    """
+    frames = queued = largest = 0
+    for client_session in client_sessions:
+        writer = client_session.writer
+        frames += len(writer.queue)
+        queued += writer.buffered
+        largest = max(largest, writer.buffered)
+    return frames, queued, largest
+
+
+def label(value) -> str:
+    """
+    :param value: str
+    :return: value escaped for a Prometheus label
+    """
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render(sessions) -> str:
+    """
+    :param sessions: session.SessionRegistry
+    :return: every metric in the Prometheus text format
+    """
+    lines = []
+
+    def metric(name, kind, description, samples) -> None:
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{labels} {value}")
+
+    metric("frames_received_total", "counter", "frames read from all connections",
+           [("", framing.traffic_counters["frames_received"])])
+    metric("bytes_received_total", "counter", "bytes read from all connections",
+           [("", framing.traffic_counters["bytes_received"])])
+    metric("frames_sent_total", "counter", "frames written to all connections",
+           [("", outbound.traffic_counters["frames_sent"])])
+    metric("bytes_sent_total", "counter", "bytes written to all connections",
+           [("", outbound.traffic_counters["bytes_sent"])])
+    metric("flushes_total", "counter", "vectored sends of the client writers",
+           [("", outbound.traffic_counters["flushes"])])
+    metric("compression_input_bytes_total", "counter", "bytes of batches before compression",
+           [("", outbound.traffic_counters["compressed_in"])])
+    metric("compression_output_bytes_total", "counter", "bytes of batches after compression",
+           [("", outbound.traffic_counters["compressed_out"])])
+    metric("backpressure_actions_total", "counter", "chat frames dropped or clients disconnected by the policy",
+           [(f'{{action="{action}"}}', count) for action, count in sorted(outbound.policy_counters.items())])
+    metric("flood_control_actions_total", "counter", "messages held back by the flood control",
+           [(f'{{action="{action}"}}', count) for action, count in sorted(ratelimit.flood_counters.items())])
+    metric("admission_rejections_total", "counter", "connections and joins rejected by the admission control",
+           [(f'{{reason="{reason}"}}', count) for reason, count in sorted(admission.admission_counters.items())])
+    metric("log_records_dropped_total", "counter", "log records lost to a full log queue",
+           [("", log.log_counters["dropped"])])
+    metric("commands_total", "counter", "commands handled in the main lobby",
+           [(f'{{command="{command}"}}', count) for command, count in sorted(commands.items())])
+    for name, count in sorted(counters.items()):
+        metric(f"{name}_total", "counter", name.replace("_", " "), [("", count)])
+
+    metric("connections", "gauge", "connected clients", [("", len(sessions))])
+    metric("lobby_members", "gauge", "members of every lobby connected to this process",
+           [(f'{{lobby="{label(name or "main")}"}}', len(members)) for name, members in sessions.by_lobby.items()])
+
+    frames, queued, largest = queue_depths(sessions.by_fd.values())
+    metric("outbound_queued_frames", "gauge", "frames waiting in client writers", [("", frames)])
+    metric("outbound_queued_bytes", "gauge", "bytes waiting in client writers", [("", queued)])
+    metric("outbound_largest_queue_bytes", "gauge", "bytes waiting in the fullest client writer", [("", largest)])
+
+    lines += fanout_seconds.render()
+    lines += loop_lag_seconds.render()
+    return "\n".join(lines) + "\n"
+
+
+def summary(lobby_object) -> str:
+    """
+    Only covers the lobby itself, its admin is any client that created a room.
+    :param lobby_object: lobby.Lobby
+    :return: short human readable overview for !stats
+    """
+    members = lobby_object.connected_clients
+    frames, queued, largest = queue_depths(members.values())
+    return (f"[stats] lobby {lobby_object.name}: {len(members)} members"
+            f" (+{lobby_object.remote_members()} on other workers)"
+            f", history: {len(lobby_object.history)} messages"
+            f"\n[stats] queued: {frames} frames / {queued} bytes (largest {largest} bytes)"
+            f", backpressure policy: {lobby_object.policy.mode}")
+
+
+async def serve(host, port, sessions) -> None:
+    """
+    serves the metrics over HTTP (any request path returns them).
+    :param host: str (should stay a local address)
+    :param port: int
+    :param sessions: session.SessionRegistry
+    :return: -
+    """
+    loop = asyncio.get_running_loop()
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(8)
+    server.setblocking(False)
+    logger.info("metrics_serving", url=f"http://{host}:{port}/metrics")
+
+    async def respond(client) -> None:
+        try:
+            request = b""
+            while b"\r\n\r\n" not in request and len(request) < 8192:
+                data = await asyncio.wait_for(loop.sock_recv(client, 1024), 5)
+                if not data:
+                    return
+                request += data
+
+            body = render(sessions).encode()
+            await loop.sock_sendall(client, b"HTTP/1.1 200 OK\r\n"
+                                            b"Content-Type: text/plain; version=0.0.4\r\n"
+                                            b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                                            b"Connection: close\r\n\r\n" + body)
+        except (OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            client.close()
+
+    while True:
+        client, _ = await loop.sock_accept(server)
+        loop.create_task(respond(client))
+
+
+def start(sessions, host=None, port=None) -> None:
+    """
+    starts measuring the event loop lag and, with a port, the metrics endpoint.
+    :param sessions: session.SessionRegistry
+    :param host: str
+    :param port: optional int
+    :return: -
+    """
+    loop = asyncio.get_running_loop()
+    loop.create_task(monitor_loop_lag())
+    if port is not None:
+        loop.create_task(serve(host, port, sessions))
@@ -0,0 +1,384 @@
+import framing
+import log
+import profiling
+
+import asyncio
+import collections
+import socket
+import zlib
+
+
+"""
+BACKPRESSURE POLICIES
+what happens to chat frames when a client does not read fast enough:
+drop_oldest : discards the oldest queued chat frames to make room for new ones.
+drop_newest : discards new chat frames until the queue drained below the low watermark.
+disconnect  : discards new chat frames and disconnects the client if it stays over the limit for too long.
+
+policy_counters counts the actions: drop_oldest (old frame discarded), drop_newest (new frame discarded by
+drop_newest), rejected (new frame discarded by disconnect, or by drop_oldest when it can't free enough room)
+and disconnect (client disconnected).
+"""
+
+logger = log.get_logger("outbound")
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+DISCONNECT = "disconnect"
+
+POLICIES = (DROP_OLDEST, DROP_NEWEST, DISCONNECT)
+REJECTED = "rejected"
+
+policy_counters = collections.Counter()     # action -> how often it was triggered (all connections)
+traffic_counters = collections.Counter()    # frames_sent / bytes_sent / flushes / compressed_in / compressed_out
+
+
+class BackpressurePolicy:
+    """
+    Write-buffer limits of a connection. Lobbies share one policy object with all of their members,
+    so changing it affects every member at once.
+    """
+    # Constant Variables
+    HIGH_WATERMARK = 256 * 1024     # queued bytes at which the policy starts to apply
+    LOW_WATERMARK = 64 * 1024       # queued bytes at which the connection counts as healthy again
+    DISCONNECT_AFTER = 10           # seconds over the limit before a client is disconnected
+
+    def __init__(self, mode=DROP_OLDEST, high_watermark=HIGH_WATERMARK, low_watermark=LOW_WATERMARK,
+                 disconnect_after=DISCONNECT_AFTER):
+        if mode not in POLICIES:
+            raise ValueError(f"[BackpressurePolicy] unknown policy '{mode}'.")
+        if low_watermark > high_watermark:
+            raise ValueError("[BackpressurePolicy] low watermark is larger than the high watermark.")
+
+        self.mode = mode
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.disconnect_after = disconnect_after
+
+
+DEFAULT_POLICY = BackpressurePolicy()
+
+
+class ClientWriter:
+    """
+    Outbound queue of a single connection.
+    Frames are queued without waiting and sent by a dedicated writer task,
+    so a slow client only delays its own messages and never the sender of a broadcast.
+    Only chat frames (droppable) are subject to the backpressure policy, direct replies are always queued.
+
+    The writer task coalesces frames: after a wakeup it waits up to flush_window seconds
+    (or until flush_bytes are queued) and sends the whole batch with a single vectored send.
+    A flush window of 0 sends immediately (lowest latency), larger windows save syscalls (higher throughput).
+
+    With compression enabled (!compress), every batch of at least compress_threshold bytes is sent as
+    a compressed batch of the connection's zlib stream, the compressor context lives as long as the connection.
+    """
+    # Constant Variables
+    CLOSE_TIMEOUT = 5               # seconds to wait for the queue to drain when closing
+    FLUSH_WINDOW = 0.002            # seconds frames are collected before a flush
+    FLUSH_BYTES = 64 * 1024         # byte budget of one flush, reaching it flushes immediately
+    MAX_BUFFERS = 512               # frames per vectored send (stays below IOV_MAX)
+    COMPRESS_THRESHOLD = 256        # smallest batch in bytes that is compressed
+    COMPRESS_LEVEL = 6
+
+    def __init__(self, loop, sock, policy=DEFAULT_POLICY, flush_window=FLUSH_WINDOW, flush_bytes=FLUSH_BYTES):
+        self.loop = loop
+        self.sock = sock
+        self.policy = policy
+        self.flush_window = flush_window
+        self.flush_bytes = flush_bytes
+
+        # Dynamic Variables
+        self.queue = collections.deque()    # contains tuples (frame, droppable)
+        self.buffered = 0                   # bytes currently queued
+        self.congested = False              # True between crossing the high and the low watermark
+        self.closed = False
+        self.dropped = 0                    # chat frames dropped by the policy
+
+        self._wakeup = asyncio.Event()
+        self._deadline = None               # pending disconnect timer (disconnect policy)
+        self._task = None
+        self._compressor = None             # zlib compressor, set by enable_compression()
+        self._compress_threshold = self.COMPRESS_THRESHOLD
+        self._stream_started = False        # True once a compressed batch (with the zlib header) was encoded
+        self._unsent = []                   # buffers of the batch being sent (partially written)
+
+    def enable_compression(self, threshold=COMPRESS_THRESHOLD, continued=False) -> None:
+        """
+        compresses every following batch of at least threshold bytes (the peer accepts compressed batches).
+        :param threshold: int
+        :param continued: True if another process (handoff) already sent compressed batches to the peer,
+                          the stream then continues without a new zlib header
+        :return: -
+        """
+        if self._compressor is None:
+            # every batch ends with a sync flush, so raw deflate blocks continue the peer's stream
+            wbits = -zlib.MAX_WBITS if continued else zlib.MAX_WBITS
+            self._compressor = zlib.compressobj(self.COMPRESS_LEVEL, zlib.DEFLATED, wbits)
+            self._stream_started = continued
+        self._compress_threshold = threshold
+
+    def compression_threshold(self) -> int | None:
+        """
+        :return: threshold of the compressed batches, None if compression is off
+        """
+        return None if self._compressor is None else self._compress_threshold
+
+    def stream_started(self) -> bool:
+        """
+        :return: True if a compressed batch was encoded, the peer's zlib stream has its header then (handoff)
+        """
+        return self._stream_started
+
+    def pending_output(self) -> tuple:
+        """
+        everything that wasn't written yet (handoff).
+        :return: tuple (bytes already encoded for the wire, list of queued frames)
+        """
+        return b"".join(self._unsent), [frame for frame, _ in self.queue]
+
+    def restore(self, unsent, frames) -> None:
+        """
+        takes over the pending output of the previous writer of the connection (before start()).
+        :param unsent: bytes that are written first, as they are
+        :param frames: list of queued frames
+        :return: -
+        """
+        if unsent:
+            self._unsent = [unsent]
+        for frame in frames:
+            self.send(frame)
+
+    def _compress(self, batch) -> list:
+        """
+        turns a batch into a single compressed batch (sync flushed, so the peer can decode it at once).
+        :param batch: list of frames
+        :return: list of buffers to send
+        """
+        data = b"".join(batch)
+        compressed = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self._stream_started = True
+
+        traffic_counters["compressed_in"] += len(data)
+        traffic_counters["compressed_out"] += len(compressed)
+        return [framing.encode_compressed(compressed)]
+
+    def start(self) -> None:
+        """
+        starts the writer task.
+        :return: -
+        """
+        self._task = self.loop.create_task(self._run())
+
+    def send(self, frame, droppable=False) -> bool:
+        """
+        queues an already encoded frame.
+        :param frame: bytes
+        :param droppable: True for chat frames that may be dropped under backpressure
+        :return: False if the frame was not queued
+        """
+        if self.closed:
+            return False
+
+        if droppable:
+            limit = self.policy.low_watermark if self.congested else self.policy.high_watermark
+            if self.buffered + len(frame) > limit and not self._apply_policy(len(frame)):
+                return False
+
+        self.queue.append((frame, droppable))
+        self.buffered += len(frame)
+        self._wakeup.set()
+        return True
+
+    def _apply_policy(self, size) -> bool:
+        """
+        applies the backpressure policy before a chat frame of the given size is queued.
+        :param size: int
+        :return: True if the frame may be queued anyway
+        """
+        self.congested = True
+
+        if self.policy.mode == DROP_OLDEST and self._drop_oldest(size):
+            return True
+
+        if self.policy.mode == DISCONNECT and self._deadline is None:
+            self._deadline = self.loop.call_later(self.policy.disconnect_after, self.disconnect)
+
+        self.dropped += 1
+        policy_counters[DROP_NEWEST if self.policy.mode == DROP_NEWEST else REJECTED] += 1
+        return False
+
+    def _drop_oldest(self, size) -> bool:
+        """
+        discards the oldest queued chat frames until a frame of the given size fits below the low watermark.
+        :param size: int
+        :return: True if enough space was freed
+        """
+        kept = collections.deque()
+        while self.queue and self.buffered + size > self.policy.low_watermark:
+            frame, droppable = self.queue.popleft()
+            if droppable:
+                self.buffered -= len(frame)
+                self.dropped += 1
+                policy_counters[DROP_OLDEST] += 1
+            else:
+                kept.append((frame, droppable))
+
+        kept.extend(self.queue)
+        self.queue = kept
+        return self.buffered + size <= self.policy.low_watermark
+
+    def disconnect(self) -> None:
+        """
+        disconnects a client that stayed over the limit for too long.
+        :return: -
+        """
+        self._deadline = None
+        if self.closed or not self.congested:
+            return
+
+        policy_counters[DISCONNECT] += 1
+        logger.warning("slow_client_disconnected", conn=self.sock.fileno(), queued=self.buffered)
+
+        self.closed = True
+        self.queue.clear()
+        self.buffered = 0
+        # shutting down the socket wakes up the pending receive of the connection handler.
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _drained(self) -> None:
+        """
+        clears the congestion state once the queue fell below the low watermark.
+        :return: -
+        """
+        self.congested = False
+        if self._deadline is not None:
+            self._deadline.cancel()
+            self._deadline = None
+
+    def _take_batch(self) -> list:
+        """
+        takes queued frames up to the byte budget of one flush.
+        :return: list of frames
+        """
+        batch = []
+        size = 0
+        while self.queue and size < self.flush_bytes and len(batch) < self.MAX_BUFFERS:
+            frame, _ = self.queue.popleft()
+            batch.append(frame)
+            size += len(frame)
+
+        self.buffered -= size
+
+        traffic_counters["frames_sent"] += len(batch)
+        traffic_counters["bytes_sent"] += size
+        traffic_counters["flushes"] += 1
+        return batch
+
+    async def _writable(self) -> None:
+        """
+        waits until the socket accepts data again.
+        :return: -
+        """
+        fd = self.sock.fileno()
+        waiter = self.loop.create_future()
+        self.loop.add_writer(fd, lambda: waiter.done() or waiter.set_result(None))
+        try:
+            await waiter
+        finally:
+            self.loop.remove_writer(fd)
+
+    async def _flush(self, batch) -> None:
+        """
+        sends a batch of frames with vectored sends (socket.sendmsg), handling partial writes.
+        :param batch: list of frames
+        :return: -
+        """
+        if self._compressor is not None and sum(len(frame) for frame in batch) >= self._compress_threshold:
+            batch = self._compress(batch)
+        await self._send(batch)
+
+    async def _send(self, buffers) -> None:
+        """
+        writes buffers completely, what is left of them stays in _unsent while the socket is full.
+        :param buffers: list of bytes-like objects
+        :return: -
+        """
+        if not hasattr(self.sock, "sendmsg"):
+            # platforms without sendmsg send the joined batch instead
+            await self.loop.sock_sendall(self.sock, b"".join(buffers))
+            return
+
+        while buffers:
+            try:
+                sent = self.sock.sendmsg(buffers)
+            except (BlockingIOError, InterruptedError):
+                self._unsent = buffers
+                await self._writable()
+                continue
+
+            # skips every buffer that was sent completely and cuts the partially sent one
+            index = 0
+            while index < len(buffers) and sent >= len(buffers[index]):
+                sent -= len(buffers[index])
+                index += 1
+            buffers = buffers[index:]
+            if sent:
+                buffers[0] = memoryview(buffers[0])[sent:]
+        self._unsent = []
+
+    async def _run(self) -> None:
+        """
+        drains the queue until the writer is closed.
+        :return: -
+        """
+        try:
+            if self._unsent:
+                await self._send(self._unsent)
+
+            while True:
+                await self._wakeup.wait()
+
+                # collects more frames before flushing
+                if self.flush_window and not self.closed and self.buffered < self.flush_bytes:
+                    await asyncio.sleep(self.flush_window)
+                self._wakeup.clear()
+
+                while self.queue:
+                    started = profiling.now()
+                    await self._flush(self._take_batch())
+                    profiling.record("writer.flush", started)
+
+                    if self.congested and self.buffered <= self.policy.low_watermark:
+                        self._drained()
+
+                if self.closed:
+                    break
+        except OSError:
+            # connection is gone, everything still queued is lost.
+            self.closed = True
+            self.queue.clear()
+            self.buffered = 0
+        finally:
+            if self._deadline is not None:
+                self._deadline.cancel()
+                self._deadline = None
+
+    async def close(self) -> None:
+        """
+        stops accepting frames and waits (bounded) until the queue is flushed.
+        :return: -
+        """
+        self.closed = True
+        self._wakeup.set()
+
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._task, self.CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.queue.clear()
+            self.buffered = 0
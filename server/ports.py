@@ -1,38 +1,26 @@
-from server import PORT
-
-import threading
 import socket
-import random
 
-blocked_ports = [PORT]
+
+BACKLOG = 8
 
 
-def port_is_open(host, port, timeout=5) -> bool:
+def open_listener(host, port=0, backlog=BACKLOG, reuse_address=False) -> socket.socket:
     """
-    Checks if a port is open or closed.
+    Creates a non-blocking listening TCP socket. Port 0 lets the kernel pick any free port.
     :param host: str
     :param port: int
-    :param timeout: int
-    :return: bool
+    :param backlog: int
+    :param reuse_address: bool -> allows binding a port that still has connections in TIME_WAIT (SO_REUSEADDR)
+    :return: socket (use getsockname()[1] to read the port)
     """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
-        with socket.create_connection((host, port), timeout):
-            return True
-    except (socket.timeout, ConnectionRefusedError):
-        return False
-
-
-def get_open_port(HOST) -> int:
-    """
-    checks for open ports.
-    :return: int -> open port
-    """
-    port_range_start = 10000
-    port_range_end = 20000
-
-    random_port = random.randint(port_range_start, port_range_end)
-
-    while random_port in blocked_ports or threading.Thread(target=port_is_open, args=(HOST, random_port)).start():
-        random_port = random.randint(port_range_start, port_range_end)
-    blocked_ports.append(random_port)
-    return random_port
+        if reuse_address:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(backlog)
+    except OSError:
+        sock.close()
+        raise
+    sock.setblocking(False)
+    return sock
@@ -0,0 +1,189 @@
+import log
+
+import asyncio
+import collections
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+
+"""
+PROFILING (opt-in)
+Started with the environment variable CHAT_PROFILE=<seconds> or the admin command !profile [seconds].
+Any lobby admin can send !profile, so the command is refused unless the server runs with --allow-profile.
+For the given window the server
+- samples the stack of the event loop thread (CPU profile, collapsed stacks for flame graph tools),
+- traces memory allocations (tracemalloc snapshot at the end of the window),
+- times the stages of the connection handlers (receive, dispatch, send).
+The results are written to CHAT_PROFILE_DIR (default: ./profiles) once the window is over.
+
+While profiling is off the handlers only pay for now() returning None and record() returning immediately.
+"""
+
+logger = log.get_logger("profiling")
+
+PROFILE_DIR = os.environ.get("CHAT_PROFILE_DIR", "profiles")
+DEFAULT_SECONDS = 30
+MAX_SECONDS = 300
+SAMPLE_INTERVAL = 0.005     # seconds between two stack samples
+
+enabled = False
+allow_command = False       # lobby admins may start a window with !profile (--allow-profile)
+stage_times = {}            # stage -> list [count, total seconds, max seconds]
+
+_session = None             # running ProfileSession
+
+
+def now() -> float | None:
+    """
+    :return: start time of a stage, None while profiling is off
+    """
+    return time.perf_counter() if enabled else None
+
+
+def record(stage, started) -> None:
+    """
+    adds the time since started to a stage.
+    :param stage: str
+    :param started: result of now()
+    :return: -
+    """
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    times = stage_times.get(stage)
+    if times is None:
+        stage_times[stage] = [1, elapsed, elapsed]
+    else:
+        times[0] += 1
+        times[1] += elapsed
+        times[2] = max(times[2], elapsed)
+
+
+class ProfileSession(threading.Thread):
+    """
+    Samples the event loop thread for a bounded window and writes the results afterwards.
+    """
+    def __init__(self, loop_thread_id, seconds, directory, interval=SAMPLE_INTERVAL):
+        super().__init__(name="chat-profiler", daemon=True)
+        self.loop_thread_id = loop_thread_id
+        self.seconds = seconds
+        self.directory = directory
+        self.interval = interval
+
+        # Dynamic Variables
+        self.stacks = collections.Counter()     # collapsed stack -> samples
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        """
+        samples until the window is over or stop() is called, then writes the results.
+        :return: -
+        """
+        global enabled, _session
+
+        deadline = time.monotonic() + self.seconds
+        while not self.stopped.wait(self.interval) and time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is not None:
+                self.stacks[self._collapse(frame)] += 1
+
+        enabled = False
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        try:
+            self._write(snapshot)
+        except OSError as error:
+            logger.error("profile_write_failed", directory=self.directory, error=error)
+        _session = None
+
+    @staticmethod
+    def _collapse(frame) -> str:
+        """
+        :param frame: innermost frame of the sampled thread
+        :return: 'outer;...;inner' with one 'file:function' entry per frame
+        """
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def _write(self, snapshot) -> None:
+        """
+        writes cpu-, memory- and stages- files of this window.
+        :param snapshot: tracemalloc.Snapshot
+        :return: -
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        suffix = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+
+        with open(os.path.join(self.directory, f"cpu-{suffix}.folded"), "w") as file:
+            for stack, samples in self.stacks.most_common():
+                file.write(f"{stack} {samples}\n")
+
+        with open(os.path.join(self.directory, f"memory-{suffix}.txt"), "w") as file:
+            statistics = snapshot.statistics("lineno")
+            file.write(f"allocated: {sum(stat.size for stat in statistics)} bytes in {len(statistics)} lines\n")
+            for stat in statistics[:50]:
+                file.write(f"{stat}\n")
+
+        with open(os.path.join(self.directory, f"stages-{suffix}.txt"), "w") as file:
+            file.write("stage\tcount\ttotal_ms\tmean_us\tmax_ms\n")
+            for stage, (count, total, longest) in sorted(stage_times.items()):
+                file.write(f"{stage}\t{count}\t{total * 1000:.3f}\t{total / count * 1e6:.1f}\t{longest * 1000:.3f}\n")
+
+        logger.info("profile_written", samples=sum(self.stacks.values()), directory=self.directory, suffix=suffix)
+
+    def stop(self) -> None:
+        """
+        ends the window early.
+        :return: -
+        """
+        self.stopped.set()
+
+
+def start(seconds=DEFAULT_SECONDS, directory=PROFILE_DIR) -> bool:
+    """
+    starts a profiling window. Must be called from the event loop thread.
+    :param seconds: length of the window (at most MAX_SECONDS)
+    :param directory: where the results are written
+    :return: False if a window is already running
+    """
+    global enabled, _session
+
+    if _session is not None:
+        return False
+
+    asyncio.get_running_loop()      # the sampled thread is the one running the event loop
+    stage_times.clear()
+    tracemalloc.start()
+
+    _session = ProfileSession(threading.get_ident(), min(seconds, MAX_SECONDS), directory)
+    enabled = True
+    _session.start()
+    logger.info("profiling_started", seconds=min(seconds, MAX_SECONDS))
+    return True
+
+
+def start_from_environment() -> None:
+    """
+    starts a window if CHAT_PROFILE=<seconds> is set.
+    :return: -
+    """
+    seconds = os.environ.get("CHAT_PROFILE")
+    if not seconds:
+        return
+    try:
+        seconds = float(seconds)
+    except ValueError:
+        # a typo must not keep the server from starting
+        logger.error("profile_env_invalid", value=seconds)
+        return
+    if seconds > 0:
+        start(seconds)
+    else:
+        logger.error("profile_env_invalid", value=seconds)
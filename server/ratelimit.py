@@ -0,0 +1,119 @@
+import collections
+import time
+
+
+"""
+FLOOD CONTROL
+Every connection has one token bucket per message type (chat lines and commands).
+A message takes one token, tokens refill at `rate` per second up to `burst`.
+The limits belong to a FloodPolicy: the main lobby has one, every lobby has its own (!set_flood).
+
+check() returns what to do with a message:
+allow : dispatch it.
+warn  : drop it and tell the client to slow down (first message over the limit).
+drop  : drop it silently (further messages over the limit, or the client is muted).
+mute  : drop it and tell the client it is muted (too many messages over the limit in a row).
+"""
+
+CHAT = 0
+COMMAND = 1
+
+KINDS = {"chat": CHAT, "command": COMMAND}
+
+ALLOW = "allow"
+WARN = "warn"
+DROP = "drop"
+MUTE = "mute"
+
+flood_counters = collections.Counter()      # action -> how often it was taken (all connections)
+
+
+class RateLimit:
+    """
+    Refill rate (tokens per second) and burst size of a token bucket.
+    """
+    __slots__ = ("rate", "burst")
+
+    def __init__(self, rate, burst):
+        if rate <= 0 or burst < 1:
+            raise ValueError("[RateLimit] rate must be positive and burst at least 1.")
+        self.rate = rate
+        self.burst = burst
+
+
+class FloodState:
+    """
+    Token buckets of one connection. A bucket is a list [tokens, last refill], a new bucket is full.
+    """
+    __slots__ = ("buckets", "throttled", "muted_until")
+
+    def __init__(self):
+        self.buckets = [None, None]     # CHAT, COMMAND
+        self.throttled = 0              # messages over the limit in a row
+        self.muted_until = 0.0
+
+
+class FloodPolicy:
+    """
+    Limits shared by every member of a lobby, changing them affects every member at once.
+    """
+    # Constant Variables
+    CHAT_RATE = 5                   # chat lines per second
+    CHAT_BURST = 10
+    COMMAND_RATE = 2                # commands per second
+    COMMAND_BURST = 5
+    MUTE_AFTER = 20                 # messages over the limit in a row until the client is muted
+    MUTE_SECONDS = 30
+
+    def __init__(self, chat=None, command=None, mute_after=MUTE_AFTER, mute_seconds=MUTE_SECONDS):
+        self.limits = [chat or RateLimit(self.CHAT_RATE, self.CHAT_BURST),
+                       command or RateLimit(self.COMMAND_RATE, self.COMMAND_BURST)]
+        self.mute_after = mute_after
+        self.mute_seconds = mute_seconds
+
+    def set_limit(self, kind, rate, burst) -> None:
+        """
+        :param kind: CHAT or COMMAND
+        :param rate: tokens per second
+        :param burst: bucket size
+        :return: -
+        """
+        self.limits[kind] = RateLimit(rate, burst)
+
+    def check(self, state, kind, now=None) -> str:
+        """
+        takes a token for a message.
+        :param state: FloodState of the sender
+        :param kind: CHAT or COMMAND
+        :param now: optional time.monotonic()
+        :return: ALLOW, WARN, DROP or MUTE
+        """
+        if now is None:
+            now = time.monotonic()
+
+        if state.muted_until > now:
+            action = DROP
+        else:
+            limit = self.limits[kind]
+            bucket = state.buckets[kind]
+            if bucket is None:
+                bucket = state.buckets[kind] = [limit.burst, now]
+            else:
+                bucket[0] = min(limit.burst, bucket[0] + (now - bucket[1]) * limit.rate)
+                bucket[1] = now
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                state.throttled = 0
+                return ALLOW
+
+            state.throttled += 1
+            if state.throttled >= self.mute_after:
+                state.throttled = 0
+                state.muted_until = now + self.mute_seconds
+                action = MUTE
+            else:
+                action = WARN if state.throttled == 1 else DROP
+
+        flood_counters[action] += 1
+        return action
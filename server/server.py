@@ -1,11 +1,34 @@
-import threading
+import argparse
 import asyncio
-import json
+import itertools
+import signal
 import socket
-
+import sys
+import os
+import time
+
+# shared protocol modules (framing, ...) live in ../common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+import framing
+import admission
+import bus
+import handoff
+import heartbeat
+import chatlog
+import cluster
+import directory
 import lobby
+import log
+import metrics
+import outbound
+import profiling
+import ratelimit
 import server_exceptions
 import server_response
+import session
+import wire
+import workers
 
 
 #                               #
@@ -15,14 +38,42 @@ import server_response
 
 HOST = socket.gethostbyname(socket.gethostname())
 PORT = 8888
-BUFFER = 1024
+BUFFER = framing.BUFFER
+FLUSH_WINDOW = outbound.ClientWriter.FLUSH_WINDOW     # outbound coalescing window in seconds (0 = lowest latency)
+FLUSH_BYTES = outbound.ClientWriter.FLUSH_BYTES       # queued bytes that flush before the window is over
+HEARTBEAT_INTERVAL = heartbeat.HeartbeatMonitor.PING_INTERVAL   # seconds until quiet clients are pinged (0 = off)
+LISTEN_BACKLOG = 1024       # pending connections the kernel queues (capped by net.core.somaxconn)
+ACCEPT_BATCH = 256          # connections accepted per readiness event before other connections get their turn
+ACCEPT_PAUSE = 0.1          # seconds accepting pauses when accept() fails (e.g. out of file descriptors)
+REJECT_LINGER = 1           # seconds a rejected connection stays open so the client can read the response
 
-connected_clients = []
-running_lobby_threads = []
+MAIN_LOBBY = 'main'
+COMMANDS = ("!help", "!exit", "!join", "!create", "!lobbies", "!wire", "!compress")     # commands of the main lobby (counted by name)
 
-running_lobbies = {
-    'main': (HOST, PORT),
-}
+METRICS_HOST = "127.0.0.1"  # the metrics endpoint is only reachable locally
+METRICS_PORT = None         # port of the metrics endpoint (--metrics-port), worker n uses METRICS_PORT + n
+
+sessions = session.SessionRegistry()   # every connected client, indexed by fd, username and lobby
+client_lobbies = {}                     # fd -> lobby the client is about to enter
+user_ids = itertools.count()            # source of unique usernames
+username_format = "user-{}"             # cluster nodes add their port to stay unique across nodes
+
+running_lobbies = {}        # lobby name -> lobby.Lobby (members connected to this process)
+lobby_directory = directory.LobbyDirectory()    # every known lobby, including the ones of other processes
+
+flood_policy = ratelimit.FloodPolicy()      # flood control of the main lobby (lobbies have their own)
+admission_control = admission.AdmissionControl()    # connection limits, configured with --max-connections, ...
+
+heartbeats = None           # heartbeat.HeartbeatMonitor, created by run_server
+
+bus_client = None           # bus.BusEndpoint in worker (--workers) or cluster mode, lobbies then span processes
+
+HANDOFF_PATH = None         # Unix socket for graceful upgrades (--handoff), see handoff.py
+
+LOG_DIR = None              # directory of the chat log (--log-dir), transcripts aren't persisted without it
+chat_log = None             # chatlog.ChatLog of this process
+
+logger = log.get_logger("server")
 
 
 """
@@ -35,7 +86,38 @@ exit_msg = "[Lobby] Closing connection..."
 help_msg = ("[help] List of commands to use in this lobby.\n!help\t\t\t\t\t:\tlists all available commands."
             "\n!join [lobby name]\t\t:\tconnects you to another lobby."
             "\n!create [lobby name]\t:\tcreates new lobby."
-            "\n!lobbies\t\t\t\t:\tlists all available lobbies.")
+            "\n!lobbies [prefix] [page]\t:\tlists all available lobbies (starting with prefix).")
+
+
+"""
+PRE-ENCODED RESPONSES
+constant responses are serialized once at startup, dynamic text messages only encode their text.
+"""
+
+joining_response = server_response.StaticResponse(1, HOST, msg=joining_msg)
+help_response = server_response.StaticResponse(1, HOST, msg=help_msg)
+exit_response = server_response.StaticResponse(5, HOST, msg=exit_msg)
+already_joined_response = server_response.StaticResponse(1, HOST, msg="[Lobby] You are already in the main lobby.")
+
+unknown_command_response = server_response.StaticResponse(3, HOST, msg="Unknown command.")
+lobby_not_found_response = server_response.StaticResponse(3, HOST, msg="Could not find lobby.")
+join_failed_response = server_response.StaticResponse(3, HOST, msg="Couldn't join lobby.")
+create_failed_response = server_response.StaticResponse(3, HOST, msg="Couldn't create a lobby")
+lobby_full_response = server_response.StaticResponse(3, HOST, msg="[Lobby] This lobby is full.")
+ping_response = server_response.StaticResponse(6, HOST, msg="ping")
+throttled_response = server_response.StaticResponse(3, HOST, msg="[Lobby] You are sending too fast, slow down.")
+muted_response = server_response.StaticResponse(
+    3, HOST, msg=f"[Lobby] You are muted for {flood_policy.mute_seconds} seconds.")
+
+message_template = server_response.ResponseTemplate(1, HOST)
+
+# sent before a connection was negotiated, JSON is understood by every client
+rejected_responses = {
+    admission.SERVER_FULL: server_response.StaticResponse(
+        5, HOST, msg="[Lobby] The server is full, try again later.").frame(wire.JSON),
+    admission.RATE_LIMIT: server_response.StaticResponse(
+        5, HOST, msg="[Lobby] Too many connections from your address, try again later.").frame(wire.JSON)
+}
 
 
 #           #
@@ -43,106 +125,165 @@ help_msg = ("[help] List of commands to use in this lobby.\n!help\t\t\t\t\t:\tli
 #           #
 
 
-def check_running_lobbies(lobby_data) -> bool:
+def check_running_lobbies(lobby_name) -> bool:
     """
-    checks if lobby_data already exists
-    :param lobby_data:
+    checks if a lobby with that name already exists
+    :param lobby_name: str
     :return: bool
     """
-    lobby_exists = False
-    for lobby_name in running_lobbies:
-        # iterates through running_lobbies vector
-        if running_lobbies[lobby_name] == lobby_data or lobby_name == lobby_data:
-            # checks if the lobby already exists in the vector.
-            lobby_exists = True
-            break
-    return lobby_exists
+    return lobby_name == MAIN_LOBBY or lobby_name in lobby_directory
 
 
-def join_lobby(lobby_host, lobby_port) -> dict:
+def join_lobby(lobby_name, client_session) -> bytes:
     """
-
-    :param lobby_host: str
-    :param lobby_port: int
-    :return: dict
+    Marks the client to be moved into the lobby once the response is sent.
+    :param lobby_name: str
+    :param client_session: session.Session
+    :return: bytes (response frame)
     """
     try:
-        if not check_running_lobbies((lobby_host, lobby_port)):
-            raise server_exceptions.LobbyError("[join_lobby] couldn't find any running lobby with that data.")
-        response = server_response.generate_response(2, HOST, connection=[lobby_host, lobby_port])
+        if lobby_name not in running_lobbies:
+            if lobby_name not in lobby_directory:
+                raise server_exceptions.LobbyError("[join_lobby] couldn't find any running lobby with that name.")
+            # lobby only has members on other workers, this process needs its own lobby object
+            create_lobby(lobby_name, client_session)
+        client_lobbies[client_session.fd] = running_lobbies[lobby_name]
+        response = message_template.render(f"[Lobby] Joining '{lobby_name}'...", client_session.codec)
     except server_exceptions.LobbyError:
-        response = server_response.generate_response(3, HOST, msg="Couldn't join lobby.")
+        response = join_failed_response.frame(client_session.codec)
     return response
 
 
-def create_lobby(lobby_name, creator_client) -> tuple:
+def redirect_lobby(lobby_name, endpoint, client_session) -> bytes:
+    """
+    Sends the client to the cluster node that hosts the lobby (code 2: change server).
+    The client joins the lobby again after connecting to that node.
+    :param lobby_name: str
+    :param endpoint: tuple (host, port) of the node
+    :param client_session: session.Session
+    :return: bytes (response frame)
+    """
+    logger.info("redirected", conn=client_session.fd, addr=client_session.addr[0], lobby=lobby_name,
+                endpoint=f"{endpoint[0]}:{endpoint[1]}")
+    response = server_response.generate_response(2, HOST, connection=list(endpoint), lobby=lobby_name)
+    return server_response.serialize_response(response, client_session.codec)
+
+
+def create_lobby(lobby_name, creator_session) -> lobby.Lobby:
     """
     Creates a lobby object using the given information
     :param lobby_name: string
-    :param creator_client: tuple containing client socket and addr.
-    :return: tuple
+    :param creator_session: session.Session of the creator
+    :return: lobby.Lobby
     """
     new_lobby = lobby.Lobby(
         name=lobby_name,
-        creator=creator_client
+        creator=creator_session.addr,
+        sessions=sessions,
+        bus_client=bus_client,
+        chat_log=chat_log,
+        directory=lobby_directory
     )
-    # lobby thread
-    lobby_thread = threading.Thread(target=new_lobby.create_lobby)
-    lobby_thread.start()
 
-    # running lobby thread vector
-    running_lobby_threads.append(lobby_thread)
+    # running lobbies : name -> Lobby
+    running_lobbies[lobby_name] = new_lobby
+    # keeps the name taken until the creator joined
+    lobby_directory.add(lobby_name)
+
+    return new_lobby
 
-    # running lobbies : name -> Host, Port
-    running_lobbies[lobby_name] = (new_lobby.HOST, new_lobby.PORT)
 
-    return new_lobby.HOST, new_lobby.PORT
+def close_lobby(lobby_object) -> None:
+    """
+    Removes a lobby after its last client left.
+    :param lobby_object: lobby.Lobby
+    :return: -
+    """
+    if lobby_object.is_empty() and running_lobbies.get(lobby_object.name) is lobby_object:
+        logger.info("lobby_closed", lobby=lobby_object.name)
+        del running_lobbies[lobby_object.name]
+        lobby_directory.discard(lobby_object.name)
 
 
-def handle_lobby_commands(cmd, client_data, client_is_running) -> bytes:
+def list_lobbies(prefix, page, codec) -> bytes:
+    """
+    Lists one page of the lobby directory.
+    :param prefix: str -> only lobbies whose name starts with it
+    :param page: int (1 = first page)
+    :param codec: wire format of the receiving client
+    :return: bytes (response frame)
+    """
+    entries, matches = lobby_directory.search(prefix, page)
+    pages = max(1, -(-matches // lobby_directory.PAGE_SIZE))
+    if page > pages:
+        page = pages
+        entries, matches = lobby_directory.search(prefix, page)
+
+    lines = [f"[lobbies] {matches} lobbies" + (f" starting with '{prefix}'" if prefix else "") +
+             f", page {page}/{pages}"]
+    for entry in entries:
+        created = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry.created))
+        lines.append(f"{entry.name}\t{entry.member_count} members\tsince {created}")
+    if page < pages:
+        lines.append(f"[lobbies] next page: !lobbies {prefix + ' ' if prefix else ''}{page + 1}")
+    return message_template.render("\n".join(lines), codec)
+
+
+def handle_lobby_commands(cmd, client_session, client_is_running) -> bytes:
     """
     Handles the commands received by the client handler and
     creates a response accordingly.
     :param client_is_running: asyncio event
     :param cmd: command
-    :param client_data: tuple containing client socket and addr.
-    :return: response (decoded)
+    :param client_session: session.Session
+    :return: response (serialized frame in the client's wire format)
     """
-    def join() -> dict:
+    def join() -> bytes:
         """
         joins another lobby.
-        :return: dict
+        :return: bytes
         """
         if not check_running_lobbies(cmd[1]):
-            return server_response.generate_response(3, HOST, msg="Could not find lobby.")
+            return lobby_not_found_response.frame(client_session.codec)
+        if cmd[1] == MAIN_LOBBY:
+            return already_joined_response.frame(client_session.codec)
+        if not admission_control.admit_member(lobby_directory.get(cmd[1]).member_count):
+            return lobby_full_response.frame(client_session.codec)
+
+        # cluster mode: lobbies hosted by another node are joined there
+        endpoint = None if bus_client is None else bus_client.route(cmd[1])
+        if endpoint is not None:
+            return redirect_lobby(cmd[1], endpoint, client_session)
+
         client_is_running.set()
-        lobby_host, lobby_port = running_lobbies[cmd[1]]
-        return join_lobby(lobby_host, lobby_port)
+        return join_lobby(cmd[1], client_session)
 
-    def create() -> dict:
+    def create() -> bytes:
         """
-        Creates a new lobby server.
-        :return: dict
+        Creates a new lobby.
+        :return: bytes
         """
         # standard response
-        create_response = server_response.generate_response(3, host=HOST, msg="Couldn't create a lobby")
+        create_response = create_failed_response.frame(client_session.codec)
 
         # checks if lobby already exists.
         if not check_running_lobbies(cmd[1]):
             # creates lobby object
-            lobby_host, lobby_port = create_lobby(cmd[1], client_data)
-            # Preparation for closing the connection
+            create_lobby(cmd[1], client_session)
+            # Preparation for moving the client into the lobby
             client_is_running.set()
-            create_response = join_lobby(lobby_host, lobby_port)
+            create_response = join_lobby(cmd[1], client_session)
         return create_response
 
     # separates the received command into small pieces
     cmd = cmd.split(' ')
 
-    print("[DEBUG - handle_lobby_commands] - " + str(cmd))
+    if logger.enabled(log.DEBUG):
+        logger.debug("command", conn=client_session.fd, command=cmd[0], args=len(cmd) - 1)
+    metrics.commands[cmd[0] if cmd[0] in COMMANDS else "unknown"] += 1
 
-    # declaration of the response dictionary
-    response = server_response.generate_response(3, HOST, msg="Unknown command.")
+    # declaration of the response frame
+    response = unknown_command_response.frame(client_session.codec)
 
     try:
         # try to identify the first command.
@@ -152,13 +293,13 @@ def handle_lobby_commands(cmd, client_data, client_is_running) -> bytes:
                 #    sends command list    #
                 #                          #
 
-                response = server_response.generate_response(1, HOST, msg=help_msg)
+                response = help_response.frame(client_session.codec)
 
             case "!exit":
                 #                         #
                 #    closes connection    #
                 #                         #
-                response = server_response.generate_response(5, HOST, msg=exit_msg)
+                response = exit_response.frame(client_session.codec)
                 client_is_running.set()
 
             case "!join":
@@ -181,98 +322,585 @@ def handle_lobby_commands(cmd, client_data, client_is_running) -> bytes:
                                                         f"[handle_lobby_commands] Expected 1, but given {len(cmd) - 1}.")
                 response = create()
 
+            case "!lobbies":
+                #                               #
+                #    lists the known lobbies    #
+                #                               #
+
+                # !lobbies [prefix] [page], a single number is a page
+                if len(cmd) > 3 or (len(cmd) == 3 and not cmd[2].isdigit()):
+                    raise server_exceptions.CmdSetError(f"[handle_lobby_commands] Invalid parameters.\n"
+                                                        f"[handle_lobby_commands] Expected !lobbies [prefix] [page].")
+                if len(cmd) == 2 and cmd[1].isdigit():
+                    cmd.insert(1, "")
+                prefix = cmd[1] if len(cmd) > 1 else ""
+                page = max(1, int(cmd[2])) if len(cmd) > 2 else 1
+                response = list_lobbies(prefix, page, client_session.codec)
+
+            case "!wire":
+                #                                  #
+                #    negotiates the wire format    #
+                #                                  #
+
+                if not len(cmd) == 2 or cmd[1] not in wire.CODECS:
+                    raise server_exceptions.CmdSetError(f"[handle_lobby_commands] Unknown wire format.\n"
+                                                        f"[handle_lobby_commands] Expected one of {wire.CODECS}.")
+                client_session.codec = cmd[1]
+                response = message_template.render(f"[Lobby] Wire format: {cmd[1]}", client_session.codec)
+
+            case "!compress":
+                #                                                     #
+                #    enables compression of the outbound stream       #
+                #                                                     #
+
+                # !compress [threshold in bytes]
+                if len(cmd) > 2 or (len(cmd) == 2 and not cmd[1].isdigit()):
+                    raise server_exceptions.CmdSetError(f"[handle_lobby_commands] Invalid threshold.\n"
+                                                        f"[handle_lobby_commands] Expected !compress [bytes].")
+                threshold = int(cmd[1]) if len(cmd) == 2 else outbound.ClientWriter.COMPRESS_THRESHOLD
+                client_session.writer.enable_compression(threshold)
+                response = message_template.render(f"[Lobby] Compression: batches from {threshold} bytes",
+                                                   client_session.codec)
+
     except server_exceptions.CmdSetError as parameter_exception:
-        print(parameter_exception)
+        logger.debug("invalid_command", conn=client_session.fd, command=cmd[0], error=parameter_exception)
 
-    return json.dumps(response).encode()
+    return response
 
 
-async def send_all(loop, client_data, data) -> None:
+def send_all(sender, data) -> None:
     """
-    Sends data to all users in that lobby
-    :param loop: current event loop
-    :param client_data: tuple containing client socket and address
+    Sends data to all users in the main lobby.
+    The frame is encoded once and queued to every receiver's writer.
+    :param sender: session.Session that sent the message
     :param data: data to send to other clients
     :return: None
     """
-    client, addr = client_data
+    frames = {}     # codec -> frame, every wire format is serialized at most once
 
-    for con_client in connected_clients:
-        if not con_client == (client, addr):
-            await loop.sock_sendto(con_client[0], data.encode(), con_client[1])
+    for fd, receiver in sessions.members(None).items():
+        if not fd == sender.fd:
+            frame = frames.get(receiver.codec)
+            if frame is None:
+                frame = frames[receiver.codec] = message_template.render(data, receiver.codec)
+            receiver.writer.send(frame, droppable=True)
 
 
-async def handle_client(client, addr) -> None:
+async def handle_client(client_session, resumed=False) -> None:
     """
     handles the client:
      - receives data / commands
      - gracefully shuts down client after receiving !exit command.
      - handles commands with handle_lobby_commands() function
      - sends response to the client.
-    :param client:
-    :param addr:
+    :param client_session: session.Session
+    :param resumed: True for a connection taken over from the previous server process (handoff.py)
     :return: -
     """
-    loop = asyncio.get_event_loop()
+    reader = client_session.reader
+    writer = client_session.writer
+    writer.start()
 
-    # send join message #
-    join_response = server_response.generate_response(1, HOST, msg=joining_msg)
-    join_msg = json.dumps(join_response).encode()
+    try:
+        client_is_running = asyncio.Event()
 
-    await loop.sock_sendto(client, join_msg, addr)
+        # a member taken over from the previous server process continues in its lobby
+        resumed_member = resumed and client_session.fd in client_lobbies
+        if resumed_member:
+            client_is_running.set()
+        elif not resumed:
+            # send join message #
+            writer.send(joining_response.frame(client_session.codec))
+
+        # receive data from the connected client
+        while not client_is_running.is_set():
+            # waits for the next complete frame
+            started = profiling.now()
+            data = await reader.read_text()
+            profiling.record("server.receive", started)
+
+            if data is None or data == "!exit":
+                break
+            if data == "!pong":
+                # heartbeat answer, the reader already noted the activity
+                continue
+
+            # flood control, everything sent in the main lobby is a command
+            action = flood_policy.check(client_session.flood, ratelimit.COMMAND)
+            if not action == ratelimit.ALLOW:
+                if action == ratelimit.WARN:
+                    writer.send(throttled_response.frame(client_session.codec))
+                elif action == ratelimit.MUTE:
+                    writer.send(muted_response.frame(client_session.codec))
+                continue
+
+            # handles lobby commands
+            started = profiling.now()
+            response = handle_lobby_commands(data, client_session, client_is_running)
+            profiling.record("server.dispatch", started)
+
+            # sends a response in form of a hashmap (code, host, {keyword-arguments})
+            started = profiling.now()
+            writer.send(response)
+            profiling.record("server.send", started)
+
+        # moves the connection into the lobby chosen with !join / !create
+        target_lobby = client_lobbies.pop(client_session.fd, None)
+        if target_lobby is not None:
+            try:
+                await target_lobby.handle_client(client_session, resumed_member)
+            finally:
+                close_lobby(target_lobby)
+    finally:
+        # the connection is released even if handling it failed
+        if reader.error is not None:
+            logger.warning("protocol_error", conn=client_session.fd, addr=client_session.addr[0], error=reader.error)
+        logger.info("disconnected", conn=client_session.fd, addr=client_session.addr[0])
+        if heartbeats is not None:
+            heartbeats.remove(client_session)
+        sessions.remove(client_session)
+        try:
+            await writer.close()
+        finally:
+            client_session.sock.close()
+
+
+def handle_bus_message(message) -> None:
+    """
+    Hands lobby events published by other worker processes to the local lobby object.
+    :param message: dict
+    :return: -
+    """
+    if message["op"] == bus.MEMBERS:
+        lobby_directory.update(message["lobby"], message["worker"], message["count"])
+        return
 
-    client_is_running = asyncio.Event()
+    local_lobby = running_lobbies.get(message["lobby"])
+    if local_lobby is not None:
+        local_lobby.handle_bus_message(message)
 
-    # receive data from the connected client
-    while not client_is_running.is_set():
-        data = b""
 
-        # Second while-loop to receive larger data  (keyword buffer size)
-        while True:
-            # receives data with size of BUFFER
-            recv_data = (await loop.sock_recv(client, BUFFER))
-            data += recv_data
-            if len(recv_data) < BUFFER:
-                # Breaks the second while-loop if the received data is smaller than the buffer.
-                break
+def create_server_socket(reuse_port=False) -> socket.socket:
+    """
+    Creates the listening socket of the server.
+    :param reuse_port: bool -> lets several worker processes share the port (SO_REUSEPORT)
+    :return: socket
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if reuse_port:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server.bind((HOST, PORT))
+    server.listen(LISTEN_BACKLOG)
+    server.setblocking(False)
+    return server
+
+
+def add_client(loop, client, addr) -> None:
+    """
+    Creates the session of an accepted connection and starts its handler.
+    :param loop: running event loop
+    :param client: socket (non-blocking)
+    :param addr: tuple (ip, port)
+    :return: -
+    """
+    logger.info("connected", conn=client.fileno(), addr=addr[0])
+    metrics.counters["connections_accepted"] += 1
+    start_session(loop, create_session(loop, client, addr, username_format.format(next(user_ids))))
+
+
+def create_session(loop, client, addr, username) -> session.Session:
+    """
+    :param loop: running event loop
+    :param client: socket (non-blocking)
+    :param addr: tuple (ip, port)
+    :param username: str
+    :return: session.Session with reader and writer
+    """
+    return session.Session(
+        sock=client,
+        addr=addr,
+        username=username,
+        reader=framing.FrameReader(loop, client, BUFFER),
+        writer=outbound.ClientWriter(loop, client, flush_window=FLUSH_WINDOW, flush_bytes=FLUSH_BYTES)
+    )
+
+
+def start_session(loop, client_session, resumed=False) -> None:
+    """
+    Registers a session and starts its handler.
+    :param loop: running event loop
+    :param client_session: session.Session
+    :param resumed: True for a connection taken over from the previous server process
+    :return: -
+    """
+    sessions.add(client_session)
+    if heartbeats is not None:
+        heartbeats.add(client_session)
+    loop.create_task(handle_client(client_session, resumed))
+
 
-        # Decode fully received data block.
-        data = data.decode()
+def snapshot_state() -> tuple:
+    """
+    Serializes the sessions and lobbies of this process for the server taking over (handoff.py).
+    Must not await anything, the state has to stay unchanged until this process exits.
+    :return: tuple (state dict, list of client sockets in the order of state["sessions"])
+    """
+    lobbies = []
+    for name, lobby_object in running_lobbies.items():
+        if not lobby_object.is_empty():
+            entry = lobby_directory.get(name)
+            lobbies.append(handoff.dump_lobby(lobby_object, time.time() if entry is None else entry.created))
 
-        if data == "!exit":
-            break
+    # lobby by lobby in joining order, so the oldest member stays the oldest
+    clients = []
+    states = []
+    for members in sessions.by_lobby.values():
+        for client_session in members.values():
+            clients.append(client_session.sock)
+            states.append(handoff.dump_session(client_session))
 
-        # handles lobby commands
-        response = handle_lobby_commands(data, (client, addr), client_is_running)
+    return {"next_user": next(user_ids), "lobbies": lobbies, "sessions": states}, clients
 
-        # sends a response in form of a hashmap (code, host, {keyword-arguments})
-        await loop.sock_sendto(client, response, addr)
 
-    print(f"[handle_client] closing client connection with {addr[0]}")
+def restore_state(loop, clients, state) -> list:
+    """
+    Rebuilds the lobbies and sessions handed over by the previous server process.
+    :param loop: running event loop
+    :param clients: list of client sockets
+    :param state: dict (snapshot_state)
+    :return: list of session.Session to start (resumed)
+    """
+    global user_ids
+
+    user_ids = itertools.count(state["next_user"])
+
+    for lobby_state in state["lobbies"]:
+        restored_lobby = lobby.Lobby(
+            name=lobby_state["name"],
+            creator=tuple(lobby_state["creator"]),
+            sessions=sessions,
+            bus_client=bus_client,
+            chat_log=chat_log,
+            directory=lobby_directory,
+            instance=lobby_state["instance"]
+        )
+        handoff.load_lobby(restored_lobby, lobby_state)
+        running_lobbies[restored_lobby.name] = restored_lobby
+        lobby_directory.add(restored_lobby.name).created = lobby_state["created"]
+
+    restored = []
+    for client, session_state in zip(clients, state["sessions"]):
+        client_session = create_session(loop, client, tuple(session_state["addr"]), session_state["username"])
+        handoff.load_session(client_session, session_state)
+        if session_state["lobby"] is not None:
+            client_lobbies[client_session.fd] = running_lobbies[session_state["lobby"]]
+        restored.append(client_session)
+    return restored
+
+
+def finish_handoff() -> None:
+    """
+    Ends this process after its connections were handed off.
+    :return: -
+    """
+    close_chat_log()
+    log.stop()
+    # skips every cleanup, closing the handed over connections properly would end them for the new process too
+    os._exit(0)
+
+
+def reject_client(loop, client, addr, reason) -> None:
+    """
+    Answers a connection that wasn't admitted and closes it, no session is created.
+    :param loop: running event loop
+    :param client: socket (non-blocking)
+    :param addr: tuple (ip, port)
+    :param reason: admission.SERVER_FULL or admission.RATE_LIMIT
+    :return: -
+    """
+    if logger.enabled(log.DEBUG):
+        logger.debug("rejected", addr=addr[0], reason=reason)
+    try:
+        # a short frame always fits into the empty send buffer
+        client.send(rejected_responses[reason])
+        client.shutdown(socket.SHUT_WR)
+    except OSError:
+        client.close()
+        return
+    # closing right away would reset the connection if the client already sent something,
+    # which can discard the response before the client read it
+    loop.call_later(REJECT_LINGER, close_rejected, client)
+
+
+def close_rejected(client) -> None:
+    """
+    Closes a rejected connection, unread data of the client is discarded first.
+    :param client: socket (non-blocking)
+    :return: -
+    """
+    try:
+        while client.recv(BUFFER):
+            pass
+    except OSError:
+        pass
     client.close()
-    connected_clients.remove((client, addr))
 
 
-async def run_server():
+def accept_clients(loop, server) -> None:
+    """
+    Reader callback of the listening socket: drains the accept queue,
+    at most ACCEPT_BATCH connections per call so established connections aren't starved.
+    :param loop: running event loop
+    :param server: listening socket
+    :return: -
+    """
+    for _ in range(ACCEPT_BATCH):
+        try:
+            client, addr = server.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as error:
+            # the socket stays readable, so accepting pauses instead of spinning
+            logger.error("accept_failed", error=error)
+            loop.remove_reader(server.fileno())
+            loop.call_later(ACCEPT_PAUSE, loop.add_reader, server.fileno(), accept_clients, loop, server)
+            return
+
+        client.setblocking(False)
+        reason = admission_control.admit(addr[0], len(sessions))
+        if reason is None:
+            add_client(loop, client, addr)
+        else:
+            reject_client(loop, client, addr, reason)
+
+
+async def run_server(server=None, takeover=None):
     """
     Creates a server socket and handles starts the handle_client and client acceptation loop
+    :param server: optional listening socket (created with create_server_socket)
+    :param takeover: optional tuple (client sockets, state) handed over by the previous server process
     :return: -
     """
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind((HOST, PORT))
-    server.listen(8)
-    server.setblocking(False)
+    global heartbeats
+
+    if server is None:
+        server = create_server_socket()
 
     loop = asyncio.get_event_loop()
+    log.start()
+    lobby_directory.local_node = None if bus_client is None else bus_client.worker_id
+    metrics.start(sessions, METRICS_HOST, METRICS_PORT)
+    profiling.start_from_environment()
+    if HEARTBEAT_INTERVAL:
+        heartbeats = heartbeat.HeartbeatMonitor(sessions, ping_response, ping_interval=HEARTBEAT_INTERVAL)
+        loop.create_task(heartbeats.run())
+
+    if takeover is not None:
+        for client_session in restore_state(loop, *takeover):
+            start_session(loop, client_session, resumed=True)
+    if HANDOFF_PATH is not None:
+        loop.create_task(handoff.serve(loop, HANDOFF_PATH, server, snapshot_state, finish_handoff))
+
+    logger.info("listening", host=HOST, port=server.getsockname()[1])
+
+    loop.add_reader(server.fileno(), accept_clients, loop, server)
+    try:
+        # serves until the event loop is stopped
+        await loop.create_future()
+    finally:
+        loop.remove_reader(server.fileno())
+
+
+async def run_worker_server(worker_id, bus_path) -> None:
+    """
+    Connects a worker to the broadcast bus and starts serving.
+    :param worker_id: int
+    :param bus_path: path of the bus hub socket
+    :return: -
+    """
+    global bus_client
+
+    bus_client = bus.BusClient(worker_id, bus_path, handle_bus_message)
+    await bus_client.connect()
+    await run_server(create_server_socket(reuse_port=True))
+
+
+async def run_cluster_server(cluster_port, seeds, secret, routing) -> None:
+    """
+    Joins the cluster and starts serving.
+    :param cluster_port: port for connections of other nodes
+    :param seeds: list of (host, cluster port) of known nodes
+    :param secret: shared secret of the cluster nodes
+    :param routing: cluster.REDIRECT or cluster.FORWARD
+    :return: -
+    """
+    global bus_client, username_format
+
+    username_format = "user-{}@" + str(PORT)
+    bus_client = cluster.ClusterNode(HOST, PORT, cluster_port, seeds, handle_bus_message, secret, routing)
+    await bus_client.start()
+    await run_server()
+
+
+def open_chat_log(directory) -> None:
+    """
+    Starts persisting the chat messages of all lobbies of this process.
+    :param directory: log directory (a worker process uses its own subdirectory)
+    :return: -
+    """
+    global chat_log
 
-    print("[run_server] listening for incoming connections...")
+    chat_log = chatlog.ChatLog(directory)
+    chat_log.open()
 
-    while True:
-        client, addr = await loop.sock_accept(server)
-        print(f"[run_server] {addr[0]} connected to this server.")
-        connected_clients.append((client, addr))
-        loop.create_task(handle_client(client, addr))
+
+def close_chat_log() -> None:
+    """
+    Commits the messages that are still queued.
+    :return: -
+    """
+    if chat_log is not None:
+        chat_log.close()
+
+
+def run_worker(worker_id, worker_count, bus_path) -> None:
+    """
+    Entry point of a worker process.
+    :param worker_id: int
+    :param worker_count: int
+    :param bus_path: path of the bus hub socket
+    :return: -
+    """
+    global user_ids, METRICS_PORT
+
+    # usernames stay unique across all workers
+    user_ids = itertools.count(worker_id, worker_count)
+    if METRICS_PORT is not None:
+        METRICS_PORT += worker_id
+
+    # the writer thread of the parent process doesn't exist in the forked worker
+    log.start()
+    logger.info("worker_starting", worker=worker_id, pid=os.getpid())
+    if LOG_DIR is not None:
+        open_chat_log(os.path.join(LOG_DIR, f"worker-{worker_id}"))
+
+    # terminate() of the parent process stops the worker like Ctrl+C, so the chat log is committed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        asyncio.run(run_worker_server(worker_id, bus_path))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close_chat_log()
+        log.stop()
 
 
 if __name__ == "__main__":
-    asyncio.run(run_server())
+    parser = argparse.ArgumentParser(description="TCP group chat server")
+    parser.add_argument("--host", default=HOST,
+                        help="address for client connections (default: the address of the host name)")
+    parser.add_argument("--port", type=int, default=PORT,
+                        help="port for client connections")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes sharing the port (SO_REUSEPORT)")
+    parser.add_argument("--cluster-port", type=int,
+                        help="enables cluster mode, port for connections of other nodes (0: any free port)")
+    parser.add_argument("--peers", default="",
+                        help="comma separated cluster addresses (host:port) of known nodes")
+    parser.add_argument("--cluster-secret", default=os.environ.get("CHAT_CLUSTER_SECRET"),
+                        help="shared secret every cluster node authenticates with (default: CHAT_CLUSTER_SECRET)")
+    parser.add_argument("--cluster-routing", choices=cluster.ROUTING, default=cluster.REDIRECT,
+                        help="redirect clients to the node of a lobby or forward its messages between nodes")
+    parser.add_argument("--backlog", type=int, default=LISTEN_BACKLOG,
+                        help="length of the accept queue of the listening socket")
+    parser.add_argument("--max-connections", type=int, default=admission.AdmissionControl.MAX_CONNECTIONS,
+                        help="connections served per process, further ones are rejected (0: no limit)")
+    parser.add_argument("--max-lobby-members", type=int, default=admission.AdmissionControl.MAX_LOBBY_MEMBERS,
+                        help="members per lobby, further joins are rejected (0: no limit)")
+    parser.add_argument("--connect-rate", type=float, default=admission.AdmissionControl.CONNECT_RATE,
+                        help="new connections per second and address (0: no limit)")
+    parser.add_argument("--connect-burst", type=int, default=admission.AdmissionControl.CONNECT_BURST,
+                        help="connections an address may open at once before --connect-rate applies")
+    parser.add_argument("--flush-window", type=float, default=FLUSH_WINDOW,
+                        help="seconds outgoing frames are collected before a flush (0: send at once, lowest latency)")
+    parser.add_argument("--flush-bytes", type=int, default=FLUSH_BYTES,
+                        help="queued bytes that flush at once, also the most bytes sent by one flush")
+    parser.add_argument("--heartbeat", type=float, default=HEARTBEAT_INTERVAL,
+                        help="seconds without data until a client is pinged, unanswered pings disconnect (0: off)")
+    parser.add_argument("--handoff", metavar="PATH",
+                        help="Unix socket a new server process can take over the connections through")
+    parser.add_argument("--takeover", action="store_true",
+                        help="takes over the listening socket and the connections of the server at --handoff")
+    parser.add_argument("--log-dir",
+                        help="persists the chat messages of all lobbies in this directory")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serves Prometheus metrics on 127.0.0.1:<port> (worker n: port + n)")
+    parser.add_argument("--allow-profile", action="store_true",
+                        help="lets lobby admins start a profiling window with !profile")
+    parser.add_argument("--log-level", choices=log.LEVELS, default=log.LOG_LEVEL,
+                        help="lowest level of the server log (stderr)")
+    parser.add_argument("--log-format", choices=log.FORMATS, default=log.LOG_FORMAT,
+                        help="key/value pairs or one JSON object per line")
+    args = parser.parse_args()
+
+    if args.flush_window < 0 or args.flush_bytes <= 0:
+        parser.error("--flush-window can't be negative and --flush-bytes has to be positive")
+    if args.connect_rate < 0 or (args.connect_rate and args.connect_burst < 1):
+        parser.error("--connect-rate can't be negative and --connect-burst has to be at least 1")
+
+    HOST = args.host
+    PORT = args.port
+    FLUSH_WINDOW = args.flush_window
+    FLUSH_BYTES = args.flush_bytes
+    HEARTBEAT_INTERVAL = args.heartbeat
+    HANDOFF_PATH = args.handoff
+    LISTEN_BACKLOG = args.backlog
+    admission_control = admission.AdmissionControl(args.max_connections, args.max_lobby_members,
+                                                   args.connect_rate, args.connect_burst)
+    LOG_DIR = args.log_dir
+    METRICS_PORT = args.metrics_port
+    profiling.allow_command = args.allow_profile
+    # the forked worker processes (workers.FORK) inherit the settings
+    log.LOG_LEVEL = args.log_level
+    log.LOG_FORMAT = args.log_format
+    log.start()
+
+    if args.workers > 1 and args.cluster_port is None:
+        if HANDOFF_PATH is not None:
+            parser.error("--handoff can't be combined with --workers")
+        try:
+            workers.run_workers(args.workers, run_worker)
+        finally:
+            log.stop()
+    else:
+        if args.workers > 1:
+            parser.error("--workers can't be combined with cluster mode")
+        if args.takeover and args.handoff is None:
+            parser.error("--takeover needs the --handoff path of the running server")
+        if HANDOFF_PATH is not None and args.cluster_port is not None:
+            parser.error("--handoff can't be combined with cluster mode")
+        if args.cluster_port is not None and not args.cluster_secret:
+            parser.error("cluster mode needs --cluster-secret (or CHAT_CLUSTER_SECRET)")
+
+        listener = None
+        takeover = None
+        if args.takeover:
+            # the previous server exits before the chat log is opened here
+            connection, listener, clients, state = handoff.request(HANDOFF_PATH)
+            handoff.confirm(connection)
+            takeover = (clients, state)
+
+        if LOG_DIR is not None:
+            open_chat_log(LOG_DIR)
+        try:
+            if args.cluster_port is not None:
+                peers = [cluster.parse_address(peer) for peer in args.peers.split(",") if peer]
+                asyncio.run(run_cluster_server(args.cluster_port, peers, args.cluster_secret, args.cluster_routing))
+            else:
+                asyncio.run(run_server(listener, takeover))
+        except KeyboardInterrupt:
+            logger.info("stopping")
+        finally:
+            close_chat_log()
+            log.stop()
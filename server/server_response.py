@@ -1,4 +1,7 @@
 
+import framing
+import wire
+
 """
 codes:
 1: normal message
@@ -6,6 +9,7 @@ codes:
 3: Not Found
 4: Server Error
 5: close connection
+6: ping (answer with !pong)
 """
 
 
@@ -21,6 +25,52 @@ def generate_response(code, host, **kwargs) -> dict:
     return response
 
 
+def serialize_response(response, codec=wire.JSON) -> bytes:
+    """
+    serializes a response into a frame, ready to be queued for sending.
+    :param response: dict
+    :param codec: wire format of the receiving client (wire.JSON / wire.BINARY)
+    :return: bytes
+    """
+    return framing.encode_frame(wire.encode_message(response, codec))
+
+
+class StaticResponse:
+    """
+    Response that never changes, serialized once for every wire format.
+    """
+    def __init__(self, code, host, **kwargs):
+        response = generate_response(code, host, **kwargs)
+        self.frames = {codec: serialize_response(response, codec) for codec in wire.CODECS}
+
+    def frame(self, codec=wire.JSON) -> bytes:
+        """
+        :param codec: wire format of the receiving client
+        :return: bytes (cached frame)
+        """
+        return self.frames[codec]
+
+
+class ResponseTemplate:
+    """
+    Text message response (code, host, msg) with a dynamic message.
+    The encoded parts around the message are cached per wire format,
+    rendering only encodes the message and splices it in.
+    """
+    def __init__(self, code, host):
+        self.parts = {codec: wire.message_template(code, host, codec) for codec in wire.CODECS}
+
+    def render(self, msg, codec=wire.JSON) -> bytes:
+        """
+        :param msg: str
+        :param codec: wire format of the receiving client
+        :return: bytes (frame)
+        """
+        prefix, suffix = self.parts[codec]
+        body = wire.encode_text(msg, codec)
+        return b"".join((framing.HEADER.pack(len(prefix) + len(body) + len(suffix)), prefix, body, suffix))
+
+
 if __name__ == "__main__":
     response = generate_response(2, '192.168.115.200', connection=['192.168.115.200', 8000])
     print(response)
@@ -0,0 +1,120 @@
+import ratelimit
+import wire
+
+"""
+roles:
+user  : normal lobby member
+admin : may use the superuser commands of its lobby
+"""
+
+USER = "user"
+ADMIN = "admin"
+
+
+class Session:
+    """
+    State of one client connection. Uses __slots__ to keep the per-connection footprint small.
+    """
+    __slots__ = ("sock", "addr", "fd", "username", "role", "lobby", "codec", "reader", "writer", "flood")
+
+    def __init__(self, sock, addr, username, reader=None, writer=None):
+        self.sock = sock
+        self.addr = addr
+        self.fd = sock.fileno()     # stays valid as key after the socket is closed
+        self.username = username
+        self.role = USER
+        self.lobby = None           # lobby.Lobby the session is in, None for the main lobby
+        self.codec = wire.JSON      # negotiated wire format (!wire)
+        self.reader = reader        # framing.FrameReader
+        self.writer = writer        # outbound.ClientWriter
+        self.flood = ratelimit.FloodState()     # token buckets of the flood control
+
+    def lobby_name(self) -> str | None:
+        """
+        :return: name of the current lobby or None for the main lobby.
+        """
+        return None if self.lobby is None else self.lobby.name
+
+    def __repr__(self):
+        return f"Session(fd={self.fd}, addr={self.addr}, username={self.username!r}, lobby={self.lobby_name()!r})"
+
+
+class SessionRegistry:
+    """
+    Indexes all sessions by file descriptor, by username and by lobby.
+    Every operation is O(1), lobby member dicts keep the joining order (first member = oldest).
+    """
+    def __init__(self):
+        self.by_fd = {}             # fd -> Session
+        self.by_username = {}       # username -> Session
+        self.by_lobby = {}          # lobby name (None = main lobby) -> {fd: Session}
+
+    def __len__(self):
+        return len(self.by_fd)
+
+    def add(self, session) -> None:
+        """
+        registers a new session in the lobby it currently belongs to.
+        :param session: Session
+        :return: -
+        """
+        self.by_fd[session.fd] = session
+        self.by_username[session.username] = session
+        self.by_lobby.setdefault(session.lobby_name(), {})[session.fd] = session
+
+    def remove(self, session) -> None:
+        """
+        removes a session from every index.
+        :param session: Session
+        :return: -
+        """
+        if self.by_fd.pop(session.fd, None) is None:
+            return
+        self.by_username.pop(session.username, None)
+        self._unlink(session)
+
+    def move(self, session, lobby) -> None:
+        """
+        moves a session into another lobby.
+        :param session: Session
+        :param lobby: lobby.Lobby or None for the main lobby
+        :return: -
+        """
+        self._unlink(session)
+        session.lobby = lobby
+        self.by_lobby.setdefault(session.lobby_name(), {})[session.fd] = session
+
+    def get(self, fd) -> Session | None:
+        """
+        :param fd: int
+        :return: Session or None
+        """
+        return self.by_fd.get(fd)
+
+    def find(self, username) -> Session | None:
+        """
+        :param username: str
+        :return: Session or None
+        """
+        return self.by_username.get(username)
+
+    def members(self, lobby_name) -> dict:
+        """
+        :param lobby_name: str or None for the main lobby
+        :return: dict fd -> Session (read only, do not modify)
+        """
+        return self.by_lobby.get(lobby_name, {})
+
+    def _unlink(self, session) -> None:
+        """
+        removes a session from its lobby index, empty lobby entries are dropped.
+        :param session: Session
+        :return: -
+        """
+        name = session.lobby_name()
+        members = self.by_lobby.get(name)
+        if members is None:
+            return
+        members.pop(session.fd, None)
+        if not members:
+            del self.by_lobby[name]
@@ -0,0 +1,57 @@
+import bus
+import log
+
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import tempfile
+
+
+logger = log.get_logger("workers")
+
+# the workers are forked: they inherit the settings the server parsed into module globals (spawn would
+# re-import the server module with its defaults), forking is only available on POSIX like SO_REUSEPORT
+FORK = multiprocessing.get_context("fork")
+
+
+def run_workers(worker_count, target) -> None:
+    """
+    Forks worker processes sharing the listening port (SO_REUSEPORT)
+    and runs the broadcast bus hub in this process until it is interrupted.
+    :param worker_count: int
+    :param target: callable(worker_id, worker_count, bus_path) that runs one worker
+    :return: -
+    """
+    bus_path = os.path.join(tempfile.mkdtemp(prefix="tcp-group-chat-"), "bus.sock")
+
+    # the hub listens before any worker is started
+    hub_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    hub_sock.bind(bus_path)
+    hub_sock.listen(worker_count)
+
+    processes = []
+    for worker_id in range(worker_count):
+        process = FORK.Process(target=target, args=(worker_id, worker_count, bus_path), daemon=True)
+        process.start()
+        processes.append(process)
+
+    logger.info("workers_started", workers=worker_count, bus=bus_path)
+
+    # SIGTERM stops the workers just like Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        asyncio.run(bus.BusHub(hub_sock).serve())
+    except KeyboardInterrupt:
+        logger.info("workers_stopping")
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        hub_sock.close()
+        os.unlink(bus_path)
+        os.rmdir(os.path.dirname(bus_path))
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the modules import each other by their flat names, like server.py / chat_client.py do
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ("common", "server", "client"):
+    sys.path.insert(0, os.path.join(ROOT, directory))
@@ -0,0 +1,63 @@
+import chatlog
+
+
+def write(directory, batches, segment_bytes=chatlog.ChatLog.SEGMENT_BYTES) -> None:
+    """
+    commits every batch with its own open / close, a batch starts a new segment once the last one is full.
+    :param batches: lists of tuples (lobby name, message)
+    """
+    for batch in batches:
+        log = chatlog.ChatLog(directory, segment_bytes=segment_bytes, commit_window=0)
+        log.open()
+        for lobby_name, data in batch:
+            log.append(lobby_name, data)
+        log.close()
+
+
+def reopened(directory) -> chatlog.ChatLog:
+    log = chatlog.ChatLog(directory)
+    log.open()
+    return log
+
+
+def test_read_across_index_strides(tmp_path):
+    stride = chatlog.ChatLog.INDEX_STRIDE
+    records = []
+    for index in range(3 * stride + 5):
+        records += [("room", f"m{index}"), ("other", f"o{index}")]
+    write(tmp_path, [records])
+
+    log = reopened(tmp_path)
+    try:
+        for count in (1, stride - 1, stride, stride + 1, 2 * stride + 3):
+            assert log.read("room", count) == [f"m{index}" for index in range(3 * stride + 5 - count, 3 * stride + 5)]
+        assert log.read("room", 10 * stride) == [f"m{index}" for index in range(3 * stride + 5)]
+        assert log.read("missing", 10) == []
+    finally:
+        log.close()
+
+
+def test_read_across_segments(tmp_path):
+    batches = [[("room", f"m{batch}-{index}") for index in range(30)] + [("other", "x")] for batch in range(4)]
+    write(tmp_path, batches, segment_bytes=256)
+
+    log = reopened(tmp_path)
+    try:
+        assert len(log.segments) == 4
+        expected = [data for batch in batches for lobby_name, data in batch if lobby_name == "room"]
+        assert log.read("room", 45) == expected[-45:]
+        assert log.read("room", 1000) == expected
+        assert log.read("other", 3) == ["x", "x", "x"]
+    finally:
+        log.close()
+
+
+def test_read_keeps_the_newest_messages_within_the_byte_limit(tmp_path):
+    write(tmp_path, [[("room", f"{index:03d}" + "x" * 97) for index in range(50)]])
+
+    log = reopened(tmp_path)
+    try:
+        messages = log.read("room", 50, max_bytes=1000)
+        assert [message[:3] for message in messages] == [f"{index:03d}" for index in range(40, 50)]
+    finally:
+        log.close()
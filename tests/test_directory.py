@@ -0,0 +1,47 @@
+import directory
+
+
+def names(entries) -> list:
+    return [entry.name for entry in entries]
+
+
+def filled_directory(*lobby_names) -> directory.LobbyDirectory:
+    lobby_directory = directory.LobbyDirectory()
+    for lobby_name in lobby_names:
+        lobby_directory.update_local(lobby_name, 1)
+    return lobby_directory
+
+
+def test_search_pages_in_name_order():
+    lobby_directory = filled_directory(*(f"room{index:02d}" for index in range(25)))
+
+    first, matches = lobby_directory.search(page=1, page_size=10)
+    last, _ = lobby_directory.search(page=3, page_size=10)
+    assert matches == 25
+    assert names(first) == [f"room{index:02d}" for index in range(10)]
+    assert names(last) == [f"room{index:02d}" for index in range(20, 25)]
+    assert lobby_directory.search(page=4, page_size=10) == ([], 25)
+    assert lobby_directory.search(page=0, page_size=10) == ([], 25)
+
+
+def test_search_by_prefix():
+    lobby_directory = filled_directory("abc", "abd", "ab", "b", "a", "abz")
+
+    entries, matches = lobby_directory.search("ab", page_size=2)
+    assert matches == 4
+    assert names(entries) == ["ab", "abc"]
+    assert names(lobby_directory.search("ab", page=2, page_size=2)[0]) == ["abd", "abz"]
+    assert lobby_directory.search("c") == ([], 0)
+
+
+def test_lobby_stays_while_any_node_has_members():
+    lobby_directory = directory.LobbyDirectory(local_node=0)
+    lobby_directory.update("room", 0, 2)
+    lobby_directory.update("room", 1, 3)
+    assert lobby_directory.get("room").member_count == 5
+
+    lobby_directory.update("room", 0, 0)
+    assert "room" in lobby_directory
+    lobby_directory.update("room", 1, 0)
+    assert "room" not in lobby_directory
+    assert lobby_directory.search() == ([], 0)
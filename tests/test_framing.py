@@ -0,0 +1,82 @@
+import asyncio
+import socket
+import zlib
+
+import pytest
+
+import framing
+
+
+def frames_of(*payloads) -> bytes:
+    return b"".join(framing.encode_frame(payload) for payload in payloads)
+
+
+def compressed_batches(*batches) -> list:
+    """
+    :param batches: lists of payloads, every list becomes one compressed batch of the same zlib stream
+    :return: list of bytes (encoded compressed batches)
+    """
+    compressor = zlib.compressobj()
+    return [framing.encode_compressed(compressor.compress(frames_of(*payloads)) + compressor.flush(zlib.Z_SYNC_FLUSH))
+            for payloads in batches]
+
+
+def test_split_input():
+    decoder = framing.FrameDecoder()
+    data = frames_of(b"hello", b"", b"world")
+
+    frames = []
+    for index in range(len(data)):
+        frames += decoder.feed(data[index:index + 1])
+    assert frames == [b"hello", b"", b"world"]
+    assert decoder.pending() == 0
+
+
+def test_merged_input_keeps_the_incomplete_frame():
+    decoder = framing.FrameDecoder()
+    data = frames_of(b"one", b"two", b"three")
+
+    assert decoder.feed(data[:-2]) == [b"one", b"two"]
+    assert decoder.buffered() == data[-(framing.HEADER_SIZE + 5):-2]
+    assert decoder.feed(data[-2:]) == [b"three"]
+
+
+def test_compressed_batches_continue_one_stream():
+    decoder = framing.FrameDecoder()
+    decoder.accept_compression()
+    first, second = compressed_batches([b"a" * 300, b"b"], [b"c" * 300])
+
+    # the stream is split in the middle of a batch and merged with a plain frame
+    data = first + framing.encode_frame(b"plain") + second
+    assert decoder.feed(data[:7]) == []
+    assert decoder.feed(data[7:]) == [b"a" * 300, b"b", b"plain", b"c" * 300]
+
+
+def test_compressed_batch_without_negotiation():
+    with pytest.raises(framing.FrameError):
+        framing.FrameDecoder().feed(compressed_batches([b"x"])[0])
+
+
+def test_oversized_frame():
+    decoder = framing.FrameDecoder(max_frame_size=16)
+    with pytest.raises(framing.FrameError):
+        decoder.feed(framing.HEADER.pack(17))
+
+
+@pytest.mark.parametrize("data", [framing.HEADER.pack(framing.MAX_FRAME_SIZE + 1), framing.encode_frame(b"\xff\xfe")])
+def test_reader_reports_malformed_input_as_closed(data):
+    async def read(data) -> tuple:
+        local, remote = socket.socketpair()
+        local.setblocking(False)
+        with local, remote:
+            reader = framing.FrameReader(asyncio.get_running_loop(), local)
+            remote.sendall(data)
+            text = await reader.read_text()
+            # the rest of the stream isn't read anymore
+            remote.sendall(framing.encode_frame(b"fine"))
+            return text, await reader.read_text(), reader.error
+
+    first, second, error = asyncio.run(read(data))
+    assert first is None
+    assert second is None
+    assert error
@@ -0,0 +1,83 @@
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+import chat_client
+import conftest
+
+SERVER_SCRIPT = os.path.join(conftest.ROOT, "server", "server.py")
+HOST = "127.0.0.1"
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, "send_fds"), reason="the handoff needs SCM_RIGHTS")
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind((HOST, 0))
+        return probe.getsockname()[1]
+
+
+def start_server(port, handoff_path, takeover=False) -> subprocess.Popen:
+    process = subprocess.Popen([sys.executable, SERVER_SCRIPT, "--host", HOST, "--port", str(port),
+                                "--handoff", handoff_path, *(["--takeover"] if takeover else [])],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if takeover:
+        # the caller waits until the old process handed everything over and exited
+        return process
+
+    # the handoff socket is created once the server serves
+    deadline = time.time() + 10
+    while not os.path.exists(handoff_path):
+        if time.time() > deadline or process.poll() is not None:
+            process.kill()
+            raise RuntimeError("the server didn't start")
+        time.sleep(0.05)
+    return process
+
+
+async def answers_help(client) -> bool:
+    await client.send("!help")
+    while (response := await asyncio.wait_for(client.receive(), 5)) is not None:
+        if response["msg"].startswith("[help]"):
+            return True
+    return False
+
+
+def test_handoff_keeps_compressed_connections(tmp_path):
+    port = free_port()
+    handoff_path = str(tmp_path / "handoff.sock")
+    processes = [start_server(port, handoff_path)]
+
+    async def run() -> None:
+        # negotiates compression but never gets a compressed batch (zlib header still expected)
+        idle = await chat_client.open_client(HOST, port)
+        # gets a compressed batch, its stream continues in the next process
+        busy = await chat_client.open_client(HOST, port)
+        assert await answers_help(busy)
+        await asyncio.sleep(0.1)
+
+        for _ in range(2):
+            old = processes[-1]
+            processes.append(start_server(port, handoff_path, takeover=True))
+            # the old process exits once the new one has everything
+            await asyncio.get_running_loop().run_in_executor(None, old.wait, 10)
+
+            for client in (idle, busy):
+                assert await answers_help(client)
+                assert not client.closed and client.error is None
+
+        await idle.close()
+        await busy.close()
+
+    try:
+        asyncio.run(run())
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
@@ -0,0 +1,43 @@
+import admission
+import heartbeat
+
+
+def test_connect_rate_token_bucket():
+    control = admission.AdmissionControl(max_connections=0, connect_rate=2, connect_burst=3)
+
+    assert [control.admit("10.0.0.1", 0, now=0) for _ in range(4)] == [None, None, None, admission.RATE_LIMIT]
+    # other addresses have their own bucket
+    assert control.admit("10.0.0.2", 0, now=0) is None
+    # two tokens per second
+    assert control.admit("10.0.0.1", 0, now=0.5) is None
+    assert control.admit("10.0.0.1", 0, now=0.5) == admission.RATE_LIMIT
+
+
+def test_server_full():
+    control = admission.AdmissionControl(max_connections=2, connect_rate=0)
+    assert control.admit("10.0.0.1", 1) is None
+    assert control.admit("10.0.0.1", 2) == admission.SERVER_FULL
+
+
+def expiry_ticks(wheel, ticks) -> dict:
+    """
+    :return: dict key -> tick (1 = first advance) at which the key expired
+    """
+    expired = {}
+    for tick in range(1, ticks + 1):
+        for key in wheel.advance():
+            expired[key] = tick
+    return expired
+
+
+def test_timer_wheel_expires_after_the_delay():
+    wheel = heartbeat.TimerWheel(tick=1, slot_count=8)
+    wheel.schedule("soon", 3)
+    wheel.schedule("later", 20)      # more than two revolutions
+    wheel.schedule("cancelled", 2)
+    wheel.cancel("cancelled")
+    wheel.schedule("moved", 1)
+    wheel.schedule("moved", 5)
+
+    assert expiry_ticks(wheel, 24) == {"soon": 3, "moved": 5, "later": 20}
+    assert len(wheel) == 0